@@ -20,8 +20,9 @@ from PIL import Image, ImageTk
 
 # Socket communication modules
 import socket
-import pickle
+import struct
 import threading
+import topo_wire
 
 # IP and port of Ryu App
 ipRyuApp = '127.0.0.1'
@@ -55,37 +56,115 @@ def create_graph_image(netGraph, graphLabel):
     graphLabel.image = photo
     
 
-# Function to receive networkx.Graph from the Ryu App
+# Size of the receive buffer allocated once per connection, grown only for bigger frames
+FRAME_BUFFER_SIZE = 64 * 1024
+# Bigger frames can only come from a corrupted length prefix: the connection is dropped instead
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+
+# Function to fill the whole view from the connection, False if the Ryu App closed it
+def recv_into_exact(conn, view):
+    received = 0
+    while received < len(view):
+        count = conn.recv_into(view[received:])
+        if count == 0:
+            return False
+        received += count
+    return True
+
+
+# Function to read the next length prefixed frame in the reusable buffer
+# Returns the memoryview of the frame (valid until the next call) and the buffer,
+# or None and the buffer on close and on a frame longer than MAX_FRAME_SIZE
+def recv_frame(conn, header, buffer):
+    if not recv_into_exact(conn, memoryview(header)):
+        return None, buffer
+    size = struct.unpack('!I', header)[0]
+    if size > MAX_FRAME_SIZE:
+        print(f"Topology frame of {size} bytes rejected, dropping the connection")
+        return None, buffer
+    if size > len(buffer):
+        buffer = bytearray(max(size, 2 * len(buffer)))
+    frame = memoryview(buffer)[:size]
+    if not recv_into_exact(conn, frame):
+        return None, buffer
+    return frame, buffer
+
+
+# Function to apply a topology frame of the Ryu App to the graph
+# Returns the updated graph, or None if the frame does not follow the last one and a snapshot is needed
+def apply_topology_frame(netGraph, message, expectedSeq):
+    if message.get("type") == "snapshot":
+        netGraph = nx.Graph()
+        netGraph.add_nodes_from(message["nodes"])
+        netGraph.add_edges_from(message["edges"])
+        return netGraph
+    if netGraph is None or message.get("seq") != expectedSeq:
+        return None
+    for op in message["ops"]:
+        if op[0] == "add_node":
+            netGraph.add_node(op[1])
+        elif op[0] == "remove_node":
+            if netGraph.has_node(op[1]):
+                netGraph.remove_node(op[1])
+        elif op[0] == "add_edge":
+            netGraph.add_edge(op[1], op[2])
+        elif op[0] == "remove_edge":
+            if netGraph.has_edge(op[1], op[2]):
+                netGraph.remove_edge(op[1], op[2])
+    return netGraph
+
+
+# Function to receive the topology from the Ryu App
 def receive_data_thread(graphLabel):
     try:
         guiSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        guiSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         guiSocket.bind((ipRyuApp, 7001))
         # The socket will wait for one connection at a time
         guiSocket.listen(1)
 
         # We reiterate the cycle infinite times, until the parent process terminates
         while True:
-            receivedGraph = None
             conn, addr = guiSocket.accept()
-
-            # Receive and deserialize the graph object if there is data, otherwise go to write the text logs
-            data = conn.recv(4096)
-            if data:
+            netGraph = None
+            lastSeq = None
+
+            header = bytearray(4)
+            buffer = bytearray(FRAME_BUFFER_SIZE)
+
+            # The Ryu App keeps the connection open: every frame is a 4 bytes length followed by a topo_wire message.
+            # The first message is a snapshot of the topology, the next ones are the numbered changes
+            awaitingSnapshot = False
+            while True:
+                data, buffer = recv_frame(conn, header, buffer)
+                if data is None:
+                    break
                 try:
-                    receivedGraph = pickle.loads(data)
-                except pickle.UnpicklingError:
-                    receivedGraph = None
-
-                """not graphReceived and"""
-                if isinstance(receivedGraph, nx.Graph):
-                    # Create the graph and insert it into the GraphLabel
-                    create_graph_image(receivedGraph, graphLabel)
-                elif isinstance(data, bytes):
-                    pass
-                    # Append the text logs to the text box for the logs of the Ryu App
-                    # add_log(outputTextBox, data.decode())
-
-            # Close the connection when done
+                    message = topo_wire.decode(data)
+                except ValueError as e:
+                    print("Invalid topology frame:", e)
+                    message = None
+
+                if message is not None:
+                    nextGraph = apply_topology_frame(netGraph, message, None if lastSeq is None else lastSeq + 1)
+                else:
+                    nextGraph = None
+                if nextGraph is None:
+                    # A change got lost: ask the Ryu App for a new snapshot, ignoring the changes until it arrives.
+                    # An invalid frame may be the awaited snapshot itself, so it is asked for again
+                    if not awaitingSnapshot or message is None:
+                        print("Topology update out of sequence, asking for a snapshot")
+                        conn.sendall(topo_wire.RESYNC_REQUEST)
+                        awaitingSnapshot = True
+                    continue
+                netGraph = nextGraph
+                awaitingSnapshot = False
+                lastSeq = message["seq"]
+                # Create the graph and insert it into the GraphLabel
+                create_graph_image(netGraph, graphLabel)
+
+            # Close the connection when the Ryu App drops it, it will connect again
             conn.close()
 
     except Exception as e:
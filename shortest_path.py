@@ -12,21 +12,26 @@ path switching.
 
 from ryu.base import app_manager
 from ryu.controller import ofp_event
-from ryu.controller.handler import MAIN_DISPATCHER
+from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
-from ryu.ofproto import ofproto_v1_0, ofproto_v1_0_parser
+from ryu.ofproto import ofproto_v1_0, ofproto_v1_3
 
 from ryu.topology import event
 from ryu.topology.event import EventHostAdd
 from ryu.app.wsgi import ControllerBase, WSGIApplication, route
 
+from ryu.lib import hub, addrconv
 from ryu.lib.packet import packet, ether_types
-from ryu.lib.packet import ethernet, arp
+from ryu.lib.packet import ethernet, arp, ipv4
 
 from topo_manager import TopoManager
+import topo_wire
+from collections import deque
+import json
 import logging
-import pickle
 import socket
+import struct
+import time
 from webob import Response
 
 class CommunicationAPI(ControllerBase):
@@ -40,9 +45,9 @@ class CommunicationAPI(ControllerBase):
     @route('comunication', '/comunication/{src_host}/{dst_host}', methods=['GET'])
     def initiate_communication(self, req, src_host, dst_host):
         print("received request!")
-        self.controller_app.set_up_rules(src_host,dst_host)
-        
-        
+        if not self.controller_app.set_up_rules(src_host,dst_host,wait=True):
+            # The switches did not confirm the rules in time
+            return Response(status=504)
         return Response(status=200)
     
     @route('reset_rules', '/reset_rules/{src_host}/{dst_host}',methods=['GET'])
@@ -50,11 +55,50 @@ class CommunicationAPI(ControllerBase):
         print("received request at reset route")
         self.controller_app.delete_rules(str(src_host),str(dst_host))
         return Response(status=200)
+
+    @route('rule_counts', '/rule_counts', methods=['GET'])
+    def rule_counts(self, req):
+        body = json.dumps(self.controller_app.tm.get_rule_counts())
+        return Response(content_type='application/json', body=body)
+
+    @route('installed_paths', '/installed_paths', methods=['GET'])
+    def installed_paths(self, req):
+        body = json.dumps(self.controller_app.tm.get_registry())
+        return Response(content_type='application/json', body=body)
+
+    @route('port_flows', '/installed_paths/{dpid}/{port_no}', methods=['GET'])
+    def port_flows(self, req, dpid, port_no):
+        flows = self.controller_app.tm.get_flows_on_port(dpid, int(port_no))
+        body = json.dumps([{"src": src_ip, "dst": dst_ip} for src_ip, dst_ip in sorted(flows)])
+        return Response(content_type='application/json', body=body)
+
+    @route('arp_stats', '/arp_stats', methods=['GET'])
+    def arp_stats(self, req):
+        body = json.dumps(self.controller_app.arp_stats)
+        return Response(content_type='application/json', body=body)
+
+    @route('packet_in_stats', '/packet_in_stats', methods=['GET'])
+    def packet_in_stats(self, req):
+        app = self.controller_app
+        stats = dict(app.packet_in_stats)
+        stats["drops"] = {str(dpid): drops for dpid, drops in app.packet_in_drops.items()}
+        stats["queued"] = {str(dpid): len(queue) for dpid, queue in app.packet_in_queues.items()}
+        stats["reactive"] = app.reactive_stats
+        body = json.dumps(stats)
+        return Response(content_type='application/json', body=body)
+
+    @route('path_cache', '/path_cache', methods=['GET'])
+    def path_cache_stats(self, req):
+        body = json.dumps(self.controller_app.tm.get_path_cache_stats())
+        return Response(content_type='application/json', body=body)
     
 
 
 class ShortestPathSwitching(app_manager.RyuApp):
-    OFP_VERSIONS = [ofproto_v1_0.OFP_VERSION]
+    OFP_VERSIONS = [ofproto_v1_0.OFP_VERSION, ofproto_v1_3.OFP_VERSION]
+    # OpenFlow 1.3 pipeline: packets are classified in the first table, then forwarded by the second one
+    CLASSIFIER_TABLE = 0
+    FORWARDING_TABLE = 1
     
     _CONTEXTS={'wsgi':WSGIApplication}
 
@@ -62,6 +106,30 @@ class ShortestPathSwitching(app_manager.RyuApp):
         super(ShortestPathSwitching, self).__init__(*args, **kwargs)
 
         self.tm = TopoManager()
+        # Read paths hop by hop from the precomputed all-pairs next-hop table instead of searching the graph
+        self.tm.next_hop_mode = False
+        # Link cost for path selection: "hops", "latency" or "bandwidth" (fed by the port stats polling)
+        self.tm.set_cost_function("hops")
+        self.stats_interval = 5
+        # Spread host pairs over all the equal-cost shortest paths instead of a single one
+        self.ecmp_mode = False
+        # "pairwise": exact-match rules per host pair, "destination": one dl_dst rule per host per switch
+        self.forwarding_mode = "pairwise"
+        # Set up the path of a host pair on its first IPv4 packet-in, without waiting for the CommunicationAPI
+        self.reactive_mode = False
+        self.pending_setups={}      # frozenset of the two ips -> [(datapath, in_port, msg)] released once installed
+        self.reactive_stats={"setups": 0, "coalesced": 0, "released": 0, "failed": 0, "unknown_hosts": 0}
+        # Install a destination based forwarding tree towards every host as soon as it joins
+        self.proactive_mode = False
+        # Destination rules sit below the exact-match pairwise rules, which keep precedence
+        self.destination_priority = ofproto_v1_0.OFP_DEFAULT_PRIORITY - 1
+        # Timeouts of the forwarding rules (0 keeps them forever), the switches report every expired rule.
+        # None for the default: 300 s idle when reactive_mode can set the paths up again, no timeout otherwise
+        self.flow_idle_timeout = None
+        self.flow_hard_timeout = 0
+        # OpenFlow 1.3 groups of the destination trees
+        self.group_ids={}           # dst_mac -> group id, the same on every switch
+        self.installed_groups=set() # (dpid, group id) present on the switches
         self.mac_to_port={}
         logging.basicConfig(level=logging.INFO)
         self.ipRyuApp = "127.0.0.1"  
@@ -69,6 +137,42 @@ class ShortestPathSwitching(app_manager.RyuApp):
         wsgi=kwargs['wsgi']
         wsgi.register(CommunicationAPI,{'controller_instance':self}) 
         self.controller_instance = self
+        self.monitor_thread = hub.spawn(self._monitor)
+        self.pending_barriers={}    # (dpid, xid) -> hub.Event set by the barrier reply
+        self.barrier_timeout = 5
+        # ARP proxy: every ARP is punted to the controller, which answers from prebuilt reply frames
+        self.arp_priority = ofproto_v1_0.OFP_DEFAULT_PRIORITY + 1
+        self.arp_templates={}       # ip -> (mac, serialized ARP reply with the requester fields left blank)
+        self.arp_stats={"requests": 0, "replies_sent": 0, "replies_received": 0, "unknown_targets": 0}
+        # Packet-ins per ethertype class, LLDP and "ignored" ones are dropped before any parsing
+        self.packet_in_stats={"lldp": 0, "arp": 0, "ipv4": 0, "ignored": 0}
+        # Admission of the parsed packet-ins: a token bucket and a bounded queue per datapath
+        self.packet_in_rate = 100       # packet-ins per second refilled in each bucket
+        self.packet_in_burst = 200      # size of each bucket
+        self.packet_in_queue_len = 256  # packet-ins waiting per datapath before new ones are dropped
+        self.packet_in_buckets={}       # dpid -> [tokens, last refill time]
+        self.packet_in_queues={}        # dpid -> deque of (msg, ethertype)
+        self.packet_in_drops={}         # dpid -> {"rate_limited": n, "queue_full": n}
+        self.packet_in_ready = hub.Event()
+        self.packet_in_thread = hub.spawn(self._packet_in_worker)
+        # GUI channel: one long lived connection carrying length prefixed frames, fed by a bounded queue.
+        # The GUI gets a snapshot of the topology when it connects, then only the numbered changes
+        self.gui_port = 7001
+        self.gui_reconnect_interval = 1
+        self.gui_queue = deque(maxlen=16)
+        self.gui_ready = hub.Event()
+        self.gui_seq = 0            # sequence number of the last change queued for the GUI
+        self.gui_nodes=set()        # topology described by the queued changes
+        self.gui_edges=set()
+        self.gui_resync = False     # the next frame must be a snapshot
+        self.gui_socket = None      # the current connection to the GUI
+        self.gui_connection_lost = False
+        # Topology changes within this many seconds of the first one are pushed to the GUI together
+        self.gui_push_window = 0.1
+        self.gui_push_scheduled = False
+        self.gui_stats={"frames_sent": 0, "snapshots_sent": 0, "resyncs": 0, "overflows": 0,
+                       "connects": 0, "coalesced": 0}
+        self.gui_thread = hub.spawn(self._gui_sender)
     
         
     
@@ -101,8 +205,33 @@ class ShortestPathSwitching(app_manager.RyuApp):
         for port in switch.ports:
             self.logger.warn("\t%d:  %s", port.port_no, port.hw_addr)
 
-        # TODO:  Update network topology and flow rules
-        
+        dpid=str(switch.dp.id)
+        batch={}
+        self.packet_in_buckets.pop(switch.dp.id, None)
+        self.packet_in_queues.pop(switch.dp.id, None)
+        lost_hosts={mac for mac, ports in self.tm.host_to_switch_port.items() if dpid in ports}
+        lost_ips={ip for ip, mac in self.tm.host_ip_lookup.items() if mac in lost_hosts}
+        for ip in lost_ips:
+            self.arp_templates.pop(ip, None)
+
+        # Pairs with a host behind the switch cannot be repaired: clean their flows on the rest of the path
+        for src_ip, dst_ip in self.tm.get_flows_on_switch(dpid):
+            if src_ip in lost_ips or dst_ip in lost_ips:
+                src_mac=self.tm.host_ip_lookup[src_ip]
+                dst_mac=self.tm.host_ip_lookup[dst_ip]
+                path=self.tm.unregister_path((src_ip, dst_ip))
+                self.delete_pair_flows(src_mac, dst_mac, [sw for sw in path if sw!=dpid], batch)
+
+        # Same for the destination rules towards those hosts
+        for sw, rules in list(self.tm.dst_rules.items()):
+            device=self.tm.get_device_by_name(sw)
+            for mac in lost_hosts & set(rules):
+                if sw!=dpid and device is not None:
+                    self.delete_destination_rule(device.get_dp(), mac, batch)
+        self.installed_groups={key for key in self.installed_groups if str(key[0])!=dpid}
+
+        changed=self.tm.remove_switch(switch)
+        self.reprogram_paths(changed, removed_switch=dpid, batch=batch)
 
         self.send_to_thread()
 
@@ -123,10 +252,14 @@ class ShortestPathSwitching(app_manager.RyuApp):
         # TODO:  Update network topology and flow rules
         for ip in host.ipv4:
             self.tm.add_host_ip_mac_mapping(ip, host.mac)
+            self.build_arp_template(ip, host.mac)
         self.tm.add_host(host)
         self.logger.warn(f"Checking dictionaries population: host_locate->{self.tm.host_locate}")
         self.logger.warn(self.tm.network_graph )
 
+        if self.proactive_mode:
+            self.install_destination_tree(host.mac)
+
         self.send_to_thread()
 
 
@@ -147,7 +280,13 @@ class ShortestPathSwitching(app_manager.RyuApp):
                          #dst_port.dpid, dst_port.port_no, dst_port.hw_addr)
 
         # TODO:  Update network topology and flow rules
-        self.tm.add_link(src_switch,src_port_no,dst_switch,dst_port_no)
+        changed=self.tm.add_link(src_switch,src_port_no,dst_switch,dst_port_no)
+        if self.ecmp_mode:
+            # A new equal-cost path changes the path hashed to the pairs, not only the shorter ones
+            changed=self.tm.get_pairs_shortened_by_link(str(src_switch), str(dst_switch), ties=True)
+        self.reprogram_paths(changed)
+
+        self.send_to_thread()
 
 
     @set_ev_cls(event.EventLinkDelete)
@@ -163,9 +302,15 @@ class ShortestPathSwitching(app_manager.RyuApp):
         #                   src_port.dpid, src_port.port_no, src_port.hw_addr,
         #                   dst_port.dpid, dst_port.port_no, dst_port.hw_addr)
 
+        removed_ports=[(src_port.dpid, src_port.port_no), (dst_port.dpid, dst_port.port_no)]
+        # The paths moved onto their backup by the failover do not cross the link anymore, but may not be the shortest
+        crossing={(self.tm.installed_paths[pair][0], self.tm.installed_paths[pair][-1])
+                  for port in removed_ports for pair in self.tm.get_flows_on_port(*port)}
+        self.failover(src_port.dpid, src_port.port_no)
+        changed=self.tm.remove_link(link) | crossing
+        self.reprogram_paths(changed, removed_ports)
 
-
-        # TODO:  Update network topology and flow rules
+        self.send_to_thread()
 
     @set_ev_cls(event.EventPortModify)
     def handle_port_modify(self, ev):
@@ -177,156 +322,601 @@ class ShortestPathSwitching(app_manager.RyuApp):
         self.logger.warn("Port Changed:  switch%s/%s (%s):  %s",
                          port.dpid, port.port_no, port.hw_addr,
                          "UP" if port.is_live() else "DOWN")
-        
 
+        if not port.is_live():
+            self.failover(port.dpid, port.port_no)
 
-        # TODO:  Update network topology and flow rules
 
+    def _monitor(self):
+        """
+        Green thread periodically requesting the port statistics of every switch
+        """
+        while True:
+            for switch in list(self.tm.switch_lookup.values()):
+                datapath = switch.get_dp()
+                ofproto = datapath.ofproto
+                parser = datapath.ofproto_parser
+                if ofproto.OFP_VERSION == ofproto_v1_3.OFP_VERSION:
+                    req = parser.OFPPortStatsRequest(datapath, 0, ofproto.OFPP_ANY)
+                else:
+                    req = parser.OFPPortStatsRequest(datapath, 0, ofproto.OFPP_NONE)
+                datapath.send_msg(req)
+            hub.sleep(self.stats_interval)
+
+    @set_ev_cls(ofp_event.EventOFPPortStatsReply, MAIN_DISPATCHER)
+    def _port_stats_reply_handler(self, ev):
+        """
+        Event handler for the port statistics replies: updates the link weights in the topology manager
+        """
+        now = time.time()
+        dpid = ev.msg.datapath.id
+        for stat in ev.msg.body:
+            self.tm.update_port_stats(dpid, stat.port_no, stat.tx_bytes, now)
 
     def send_to_thread(self):
-        graph = self.tm.gui_graph 
-        
-        
-        # Serialize the graph using pickle
-        serialized_graph = pickle.dumps(graph)
+        """
+        Function for scheduling a push of the topology changes to the GUI.
+        The calls made within gui_push_window seconds of the first one share the same push
+        """
+        if self.gui_push_window <= 0:
+            self.push_gui_changes()
+            return
+        if self.gui_push_scheduled:
+            self.gui_stats["coalesced"] += 1
+            return
+        self.gui_push_scheduled = True
+        hub.spawn_after(self.gui_push_window, self.push_gui_changes)
 
-        # Create a socket connection and send the serialized graph
+    def push_gui_changes(self):
+        """
+        Function for queueing the changes of the topology since the last push, the _gui_sender green thread sends them.
+        Never blocks: when the GUI is too slow for the queue the changes are dropped and replaced by a snapshot
+        """
+        self.gui_push_scheduled = False
+        nodes = set(self.tm.gui_graph.nodes())
+        edges = {(u, v) if u <= v else (v, u) for u, v in self.tm.gui_graph.edges()}
+        changes = [("remove_edge",) + edge for edge in self.gui_edges - edges]
+        changes += [("remove_node", node) for node in self.gui_nodes - nodes]
+        changes += [("add_node", node) for node in nodes - self.gui_nodes]
+        changes += [("add_edge",) + edge for edge in edges - self.gui_edges]
+        if not changes:
+            return
+        # Encoded before the GUI state moves on, so that a failure leaves it describing what was sent
         try:
-            print("sending topology")
-            self.guiSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.guiSocket.connect((self.ipRyuApp, 7001))
-            self.guiSocket.send(serialized_graph)
-            self.guiSocket.close()
+            frame = topo_wire.encode_delta(self.gui_seq + 1, changes)
         except Exception as e:
-            print("Error sending graph:", e)
+            self.logger.error(f"cannot encode the topology changes for the GUI: {e}")
+            return
+        self.gui_nodes, self.gui_edges = nodes, edges
+        self.gui_seq += 1
+        if len(self.gui_queue) == self.gui_queue.maxlen:
+            # The snapshot sent instead describes the topology including these changes
+            self.gui_queue.clear()
+            self.gui_resync = True
+            self.gui_stats["overflows"] += 1
+        else:
+            self.gui_queue.append(frame)
+        self.gui_ready.set()
+
+    def get_gui_snapshot(self):
+        """
+        Function for serializing the whole topology described to the GUI, numbered like the last change
+        Parameters:
+            None
+        Returns:
+            the snapshot frame
+        """
+        return topo_wire.encode_snapshot(self.gui_seq, self.gui_nodes, self.gui_edges)
+
+    def _connect_gui(self):
+        """
+        Function for opening the connection to the GUI
+        Parameters:
+            None
+        Returns:
+            the connected socket, None if the GUI is not listening
+        """
+        try:
+            guiSocket = socket.create_connection((self.ipRyuApp, self.gui_port), timeout=self.gui_reconnect_interval)
+        except (OSError, socket.error):
+            return None
+        guiSocket.settimeout(None)
+        guiSocket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.gui_stats["connects"] += 1
+        return guiSocket
+
+    def _gui_receiver(self, guiSocket):
+        """
+        Green thread reading what the GUI sends back on its connection: a resync request when it detects a gap
+        in the sequence numbers, or the end of the connection when the GUI goes away
+        """
+        while True:
+            try:
+                data = guiSocket.recv(64)
+            except (OSError, socket.error):
+                data = b''
+            if guiSocket is not self.gui_socket:
+                # The sender already replaced this connection
+                return
+            if not data:
+                self.gui_connection_lost = True
+            elif topo_wire.RESYNC_REQUEST in data:
+                self.gui_stats["resyncs"] += 1
+            else:
+                continue
+            self.gui_resync = True
+            self.gui_ready.set()
+            if not data:
+                return
+
+    def _close_gui(self):
+        """
+        Function for closing the connection to the GUI, the next frame opens a new one
+        """
+        if self.gui_socket is not None:
+            self.gui_socket.close()
+        self.gui_socket = None
+        self.gui_connection_lost = False
+        # The GUI starts again from a snapshot on the next connection
+        self.gui_resync = True
+
+    def _gui_sender(self):
+        """
+        Green thread sending the queued topology changes to the GUI on a persistent connection.
+        Every frame is prefixed by its length. A new connection starts with a snapshot, and so does the reply
+        to a resync request of the GUI. The connection is opened again as soon as it drops
+        """
+        while True:
+            self.gui_ready.wait()
+            self.gui_ready.clear()
+            while self.gui_queue or self.gui_resync:
+                if self.gui_connection_lost:
+                    self._close_gui()
+                if self.gui_socket is None:
+                    guiSocket = self._connect_gui()
+                    if guiSocket is None:
+                        hub.sleep(self.gui_reconnect_interval)
+                        continue
+                    self.gui_socket = guiSocket
+                    self.gui_resync = True
+                    hub.spawn(self._gui_receiver, guiSocket)
+                if self.gui_resync:
+                    # The snapshot covers every queued change
+                    self.gui_queue.clear()
+                    self.gui_resync = False
+                    try:
+                        frame = self.get_gui_snapshot()
+                    except Exception as e:
+                        # Never let the sender die: the next change brings the GUI up to date
+                        self.logger.error(f"cannot encode the topology snapshot for the GUI: {e}")
+                        continue
+                    self.gui_stats["snapshots_sent"] += 1
+                else:
+                    frame = self.gui_queue.popleft()
+                try:
+                    self.gui_socket.sendall(struct.pack("!I", len(frame)) + frame)
+                except (OSError, socket.error) as e:
+                    print("Error sending graph:", e)
+                    self._close_gui()
+                    continue
+                self.gui_stats["frames_sent"] += 1
+
+    def failover(self, dpid, port_no):
+        """
+        Function for moving, in one batched flow update, every active path crossing a dead link onto its backup path
+        Parameters:
+            dpid: the dpid of a switch at one end of the failed link
+            port_no: the port of the failed link on that switch
+        Returns:
+            None
+        """
+        start=time.time()
+        neighbor=self.tm.port_neighbor.get((str(dpid), port_no))
+        if neighbor is None:
+            # Not a link between two switches: there is no way around it
+            return
+        dead_link=(str(dpid), neighbor)
+        dead={dead_link, dead_link[::-1]}
+        batch={}
+        moved=0
+        for src_ip, dst_ip in self.tm.get_flows_on_port(dpid, port_no):
+            path=self.tm.installed_paths[(src_ip, dst_ip)]
+            backup=self.tm.backup_paths.get((src_ip, dst_ip))
+            if backup is None or dead & set(zip(backup, backup[1:])) or \
+                    any(self.tm.get_link_port(a, b) is None for a, b in zip(backup, backup[1:])):
+                # The precomputed backup is gone as well: look for any path avoiding the dead link
+                backup=self.tm.get_disjoint_path(path[0], path[-1], [dead_link])
+            if backup is None:
+                self.logger.warn(f"no backup path for {src_ip} <-> {dst_ip} after failure of link {dead_link}")
+                continue
+            # The dead link is still in the topology until the link event has been handled
+            self.install_path(src_ip, dst_ip, backup, batch, avoid_links=[dead_link])
+            moved+=1
+
+        if moved:
+            self.logger.info(f"failover of {moved} paths off link {dead_link} computed in "
+                             f"{(time.time()-start)*1000:.1f} ms")
+            # Sent right away, so that the repairs queued afterwards by the same handler reach the switches later
+            barriers=self.post_batch(batch, track=True)
+            # Wait for the barrier replies outside of the event loop, which has to dispatch them
+            hub.spawn(self._confirm_failover, batch, barriers, start, moved)
+
+    def _confirm_failover(self, batch, barriers, start, moved):
+        """
+        Green thread logging the time from the link failure until the switches confirmed the failover batch
+        """
+        if self.wait_barriers(batch, barriers):
+            self.logger.info(f"failover of {moved} paths confirmed in {(time.time()-start)*1000:.1f} ms")
+        else:
+            self.logger.warn(f"failover of {moved} paths not confirmed by every switch")
+
+    def reprogram_paths(self, changed_pairs, removed_ports=(), removed_switch=None, batch=None):
+        """
+        Function for repairing, in one batched flow update, the active paths affected by a topology change
+        Parameters:
+            changed_pairs: set of (src, dst) switch pairs whose shortest path changed,
+                           None if every path has to be considered changed
+            removed_ports: (dpid, port_no) of a removed link: the paths crossing them are reinstalled as well
+            removed_switch: dpid of a removed switch, if any: the paths crossing it are reinstalled as well
+            batch: flow mods already queued by the caller, sent together with the repair
+        Returns:
+            None
+        """
+        batch={} if batch is None else batch
+        if changed_pairs is None:
+            affected=set(self.tm.installed_paths)
+        else:
+            affected=set()
+            for src_switch, dst_switch in changed_pairs:
+                affected|=self.tm.get_flows_between(src_switch, dst_switch)
+            for dpid, port_no in removed_ports:
+                affected|=self.tm.get_flows_on_port(dpid, port_no)
+            if removed_switch is not None:
+                affected|=self.tm.get_flows_on_switch(removed_switch)
+
+        if affected:
+            self.logger.info(f"Reprogramming {len(affected)} of {len(self.tm.installed_paths)} active paths")
+        for src_ip, dst_ip in affected:
+            src_mac=self.tm.host_ip_lookup[src_ip]
+            dst_mac=self.tm.host_ip_lookup[dst_ip]
+            path=self.get_pair_path(src_mac, dst_mac, self.tm.dpid_hostLookup(src_mac), self.tm.dpid_hostLookup(dst_mac))
+            if path is not None and path==self.tm.installed_paths.get((src_ip, dst_ip)):
+                # Already moved there, e.g. by the failover
+                continue
+            if path is None or len(path)<2:
+                # No route left: stop forwarding on the stale path
+                self.logger.warn(f"no path left between {src_ip} and {dst_ip}")
+                old_path=self.tm.unregister_path((src_ip, dst_ip))
+                self.delete_pair_flows(src_mac, dst_mac, old_path, batch)
+            else:
+                self.install_path(src_ip, dst_ip, path, batch)
+
+        if self.proactive_mode or self.forwarding_mode == "destination":
+            dst_switches=None if changed_pairs is None or removed_ports or removed_switch is not None \
+                else {dst for _, dst in changed_pairs}
+            destinations={mac for rules in self.tm.dst_rules.values() for mac in rules}
+            if self.proactive_mode:
+                destinations.update(self.tm.host_mac_lookup)
+            for mac in destinations:
+                if dst_switches is None or str(self.tm.dpid_hostLookup(mac)) in dst_switches:
+                    self.install_destination_tree(mac, batch)
+
+        self.send_batch(batch)
+
+    def install_destination_tree(self, dst_mac, batch=None):
+        """
+        Function for installing on every switch one rule matching only dl_dst, forwarding along the
+        shortest path tree rooted at the host. Only the rules that differ from the installed ones are sent
+        Parameters:
+            dst_mac: mac address of the destination host
+            batch: if given, the flow mods are queued in it, otherwise they are sent right away
+        Returns:
+            None
+        """
+        own_batch=batch is None
+        if own_batch:
+            batch={}
+        tree=self.tm.get_destination_tree(dst_mac)
+        next_hops=None
+
+        for switch, out_port in tree.items():
+            device=self.tm.get_device_by_name(switch)
+            if device is None or out_port is None:
+                continue
+            datapath=device.get_dp()
+            parser=datapath.ofproto_parser
+            rule=out_port
+            if datapath.ofproto.OFP_VERSION == ofproto_v1_3.OFP_VERSION and switch != str(self.tm.dpid_hostLookup(dst_mac)):
+                # Forward through a group: SELECT over the equal-cost ports with ECMP, FAST_FAILOVER otherwise
+                if next_hops is None:
+                    next_hops=self.tm.get_destination_next_hops(dst_mac)
+                ports, backup=next_hops.get(switch, ([out_port], None))
+                if self.ecmp_mode and len(ports)>1:
+                    rule=("select",)+tuple(ports)
+                else:
+                    # Prefer another equal-cost port as backup, then a loop-free alternate
+                    alternates=[port for port in ports if port!=out_port]
+                    rule=("fast_failover", out_port, alternates[0] if alternates else backup)
+            if self.tm.dst_rules.get(switch, {}).get(dst_mac)!=rule:
+                if isinstance(rule, tuple):
+                    group_id=self.group_ids.setdefault(dst_mac, len(self.group_ids)+1)
+                    if rule[0]=="select":
+                        self.install_group(datapath, group_id, datapath.ofproto.OFPGT_SELECT,
+                                           [(port, None) for port in rule[1:]], batch)
+                    else:
+                        buckets=[(port, port) for port in rule[1:] if port is not None]
+                        self.install_group(datapath, group_id, datapath.ofproto.OFPGT_FF, buckets, batch)
+                    actions=[parser.OFPActionGroup(group_id)]
+                else:
+                    actions=[parser.OFPActionOutput(out_port)]
+                match=self.build_match(datapath, dst_mac=dst_mac)
+                self.add_flow(datapath, match, actions, batch, priority=self.destination_priority)
+                self.tm.add_dst_rule(switch, dst_mac, rule)
+
+        # Switches that cannot reach the host anymore
+        for switch in [sw for sw, rules in self.tm.dst_rules.items() if dst_mac in rules and sw not in tree]:
+            self.tm.remove_dst_rule(switch, dst_mac)
+            device=self.tm.get_device_by_name(switch)
+            if device is not None:
+                self.delete_destination_rule(device.get_dp(), dst_mac, batch)
+
+        if own_batch:
+            self.send_batch(batch)
+
+    def get_pair_path(self, src_mac, dst_mac, src_dpid, dst_dpid):
+        """
+        Function for getting the switch path carrying the traffic between two hosts
+        Parameters:
+            src_mac: mac address of the source host
+            dst_mac: mac address of the destination host
+            src_dpid: dpid of the switch of the source host
+            dst_dpid: dpid of the switch of the destination host
+        Returns:
+            the list of switches on the path, None if there is no path
+        """
+        if self.ecmp_mode:
+            return self.tm.get_ecmp_path(str(src_dpid), str(dst_dpid), src_mac, dst_mac)
+        return self.tm.get_shortest_path(str(src_dpid), str(dst_dpid))
 
-    def set_up_rules(self, src_ip, dst_ip):
+    def set_up_rules(self, src_ip, dst_ip, wait=False):
         """
-        Function callable by the CommunicationAPI to set up flow rules between two hosts
+        Function callable by the CommunicationAPI to set up flow rules between two hosts.
+        The flow mods of every switch are sent in one burst, followed by a barrier request
         Parameters:
             src_ip: source ip address of one host
             dst_ip: destination ip address of the other host
+            wait: True to block until every switch on the path confirmed its rules.
+                  Must be False when called from a Ryu event handler, which would never see the replies
         Returns:
-            None
+            True if the rules have been sent (and confirmed, when waiting), False on barrier timeout
         """
         src_mac=self.tm.host_ip_lookup[src_ip]
         dst_mac=self.tm.host_ip_lookup[dst_ip]
         src_dpid=self.tm.dpid_hostLookup(src_mac)
         dst_dpid=self.tm.dpid_hostLookup(dst_mac)
-        parser=ofproto_v1_0_parser
+        batch={}
+
+        if self.forwarding_mode == "destination":
+            # The trees towards both hosts carry the two directions of the communication
+            self.logger.info(f"Setting destination rules towards {src_ip} and {dst_ip}")
+            self.install_destination_tree(src_mac, batch)
+            self.install_destination_tree(dst_mac, batch)
+            return self.send_batch(batch, wait)
 
         
         self.logger.info(f"Setting rules between {src_ip} and {dst_ip}")
 
         if str(src_dpid) in self.tm.topo and str(dst_dpid) in self.tm.topo:
-            path=self.tm.get_shortest_path(str(src_dpid), str(dst_dpid))
+            path=self.get_pair_path(src_mac, dst_mac, src_dpid, dst_dpid)
+            self.install_path(src_ip, dst_ip, path, batch)
 
-            if path is not None and len(path)>=2:
-                for i in range(0,len(path)):
-                    if i==0:
-                        #first step of the path: need to set_up the port with the src_host
-                        first=path[i]
-                        second=path[i+1]
-                        out_port=self.tm.get_output_port(first,second)
-                        in_port=self.tm.get_host_port_on_switch(src_mac,first)
-                        self.check_rule(first,in_port,out_port)
+        return self.send_batch(batch, wait)
+
+    def install_path(self, src_ip, dst_ip, path, batch, avoid_links=()):
+        """
+        Function for queueing the flow rules of a host pair along a given switch path, and computing its backup path
+        Parameters:
+            src_ip: source ip address of one host
+            dst_ip: destination ip address of the other host
+            path: the list of switches from the switch of src_ip to the switch of dst_ip
+            batch: the batch the flow mods are queued in, see add_flow
+            avoid_links: (dpid, dpid) links the backup path must not cross besides the ones of path
+        Returns:
+            None
+        """
+        src_mac=self.tm.host_ip_lookup[src_ip]
+        dst_mac=self.tm.host_ip_lookup[dst_ip]
+
+        if path is not None and len(path)>=2:
+            old_path=self.tm.installed_paths.get((src_ip, dst_ip))
+            if old_path is not None and old_path!=path:
+                # Rerouting: drop the flows of the pair on the old path, they are queued before the new ones
+                self.delete_pair_flows(src_mac, dst_mac, old_path, batch)
+            for i in range(0,len(path)):
+                if i==0:
+                    #first step of the path: need to set_up the port with the src_host
+                    first=path[i]
+                    second=path[i+1]
+                    out_port=self.tm.get_link_port(first,second)
+                    in_port=self.tm.get_host_port_on_switch(src_mac,first)
+                    self.check_rule(first,in_port,out_port,src_mac,dst_mac,batch)
+                    datapath=self.tm.get_device_by_name(first).get_dp()
+                    parser=datapath.ofproto_parser
+                    actions=[parser.OFPActionOutput(in_port)]
+                    match=self.build_match(datapath,in_port=out_port,src_mac=dst_mac,dst_mac=src_mac)
+                    self.add_flow(datapath,match,actions, batch)
+                    self.tm.add_rule_to_dict(first,out_port,in_port,dst_mac,src_mac)
+                    actions=[parser.OFPActionOutput(out_port)]
+                    match=self.build_match(datapath,in_port=in_port,src_mac=src_mac,dst_mac=dst_mac)
+                    self.add_flow(datapath,match,actions, batch)
+                    self.tm.add_rule_to_dict(first,in_port,out_port,src_mac,dst_mac)
+                    continue
+                if i==len(path)-1:
+                    #last step of the path: need to set_up the port with the dst_host
+                    last=path[i]
+                    prev=path[i-1]
+                    out_port=self.tm.get_host_port_on_switch(str(dst_mac),str(last))
+                    in_port=self.tm.get_link_port(last,prev)
+                    if in_port is not None:                                   
+                        self.check_rule(last,in_port,out_port,src_mac,dst_mac,batch)
+                        datapath=self.tm.get_device_by_name(last).get_dp()
+                        parser=datapath.ofproto_parser
+                                               
+                        actions=[parser.OFPActionOutput(out_port)]                   
+                        match=self.build_match(datapath,in_port=in_port,src_mac=src_mac,dst_mac=dst_mac)  
+                        self.add_flow(datapath,match,actions, batch)
+                        self.tm.add_rule_to_dict(last,in_port,out_port,src_mac,dst_mac)
                         actions=[parser.OFPActionOutput(in_port)]
-                        match=ofproto_v1_0_parser.OFPMatch(in_port=out_port,dl_src=dst_mac,dl_dst=src_mac)
-                        self.add_flow(self.tm.get_device_by_name(first).get_dp(),match,actions)
-                        self.tm.add_rule_to_dict(first,in_port,out_port)
-                        actions=[parser.OFPActionOutput(out_port)]
-                        match=ofproto_v1_0_parser.OFPMatch(in_port=in_port,dl_src=src_mac,dl_dst=dst_mac)
-                        self.add_flow(self.tm.get_device_by_name(first).get_dp(),match,actions)
-                        self.tm.add_rule_to_dict(first, out_port, in_port)
-                        continue
-                    if i==len(path)-1:
-                        #last step of the path: need to set_up the port with the dst_host
-                        last=path[i]
-                        prev=path[i-1]
-                        out_port=self.tm.get_host_port_on_switch(str(dst_mac),str(last))
-                        in_port=self.tm.get_output_port(last,prev)
-                        if in_port is not None:                                   
-                            self.check_rule(last,out_port,in_port)
-                                                   
-                            actions=[parser.OFPActionOutput(out_port)]                   
-                            match=ofproto_v1_0_parser.OFPMatch(in_port=in_port,dl_src=src_mac,dl_dst=dst_mac)  
-                            self.add_flow(self.tm.get_device_by_name(last).get_dp(),match,actions)                 
-                            self.tm.add_rule_to_dict(last,out_port,in_port)
-                            actions=[parser.OFPActionOutput(in_port)]
-                            match=ofproto_v1_0_parser.OFPMatch(in_port=out_port,dl_src=dst_mac,dl_dst=src_mac)         #bidirectional flow
-                            self.add_flow(self.tm.get_device_by_name(last).get_dp(), match,actions)
-                            self.tm.add_rule_to_dict(last,in_port,out_port)
-                                              
-                            self.logger.warn(f"rule state:{self.tm.flow_rules}")
-                            break
-                    else:
-                        #otherwise we are between two switches: get the in_port of the current by checking the out_port of the previous
-                        #the out_port by checking the in_port of the next one
-                        prev=path[i-1]
-                        current = path[i]
-                        next = path[i+1]
-                        self.logger.info(f"trying to set flow between {prev}, {current} and {next}")   
-                        in_port = self.tm.get_output_port(current, prev)
-                        out_port=self.tm.get_output_port(current,next)
-        
-                        if out_port is not None:
-                                            
-                            self.check_rule(current,in_port,out_port)
-                            match = ofproto_v1_0_parser.OFPMatch(in_port=in_port,dl_src=src_mac,dl_dst=dst_mac)
-                            actions = [parser.OFPActionOutput(out_port)]
-                            self.add_flow(self.tm.get_device_by_name(current).get_dp(), match, actions)
-                            actions=[parser.OFPActionOutput(in_port)]
-                            match=ofproto_v1_0_parser.OFPMatch(in_port=out_port,dl_src=dst_mac,dl_dst=src_mac) #bidirectional flow
-                            self.add_flow(self.tm.get_device_by_name(current).get_dp(),match , actions)
-                            self.tm.add_rule_to_dict(current,in_port,out_port)
-                            self.tm.add_rule_to_dict(current,out_port,in_port)
-                            self.logger.warn(f"rule state:{self.tm.flow_rules}")
+                        match=self.build_match(datapath,in_port=out_port,src_mac=dst_mac,dst_mac=src_mac)         #bidirectional flow
+                        self.add_flow(datapath, match,actions, batch)
+                        self.tm.add_rule_to_dict(last,out_port,in_port,dst_mac,src_mac)
+                                          
+                        self.logger.warn(f"rule state:{self.tm.flow_rules}")
+                        break
+                else:
+                    #otherwise we are between two switches: get the in_port of the current by checking the out_port of the previous
+                    #the out_port by checking the in_port of the next one
+                    prev=path[i-1]
+                    current = path[i]
+                    next = path[i+1]
+                    self.logger.info(f"trying to set flow between {prev}, {current} and {next}")   
+                    in_port = self.tm.get_link_port(current, prev)
+                    out_port=self.tm.get_link_port(current,next)
     
+                    if out_port is not None:
+                                        
+                        self.check_rule(current,in_port,out_port,src_mac,dst_mac,batch)
+                        datapath=self.tm.get_device_by_name(current).get_dp()
+                        parser=datapath.ofproto_parser
+                        match = self.build_match(datapath,in_port=in_port,src_mac=src_mac,dst_mac=dst_mac)
+                        actions = [parser.OFPActionOutput(out_port)]
+                        self.add_flow(datapath, match, actions, batch)
+                        actions=[parser.OFPActionOutput(in_port)]
+                        match=self.build_match(datapath,in_port=out_port,src_mac=dst_mac,dst_mac=src_mac) #bidirectional flow
+                        self.add_flow(datapath,match , actions, batch)
+                        self.tm.add_rule_to_dict(current,in_port,out_port,src_mac,dst_mac)
+                        self.tm.add_rule_to_dict(current,out_port,in_port,dst_mac,src_mac)
+                        self.logger.warn(f"rule state:{self.tm.flow_rules}")
+
+            # Link-disjoint path to fall back on when a link of the installed one fails
+            self.tm.register_path((src_ip, dst_ip), path, self.tm.get_backup_path(path, avoid_links))
+
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     def _packet_in_handler(self, ev):
         """
         Event handler for the packet in event. Sets up the proper forwanding rules on the shortest path.
+        The ethertype is read straight from the frame so that LLDP and other traffic is dropped without parsing,
+        ARP and IPv4 frames go through the per datapath rate limiter and queue before being fully parsed
+        """
+        msg = ev.msg
+        data = msg.data
+        if len(data) < 14:
+            return
+        ethertype = (data[12] << 8) | data[13]
+        if ethertype == ether_types.ETH_TYPE_LLDP:
+            # Ignore LLDP packet: ignoring the link layer discovery packets from the switches
+            self.packet_in_stats["lldp"] += 1
+            return
+        if ethertype != ether_types.ETH_TYPE_ARP and ethertype != ether_types.ETH_TYPE_IP:
+            self.packet_in_stats["ignored"] += 1
+            return
+
+        # The handler only admits the packet-in, the parsing happens in the worker thread
+        dpid = msg.datapath.id
+        drops = self.packet_in_drops.setdefault(dpid, {"rate_limited": 0, "queue_full": 0})
+        if not self._take_packet_in_token(dpid):
+            drops["rate_limited"] += 1
+            return
+        queue = self.packet_in_queues.setdefault(dpid, deque())
+        if len(queue) >= self.packet_in_queue_len:
+            drops["queue_full"] += 1
+            return
+        queue.append((msg, ethertype))
+        self.packet_in_ready.set()
+
+    def _take_packet_in_token(self, dpid):
+        """
+        Function for taking a token from the packet-in bucket of a datapath
+        Parameters:
+            dpid: the id of the datapath that sent the packet-in
+        Returns:
+            True if the packet-in is admitted, False if the datapath exceeded its rate
+        """
+        now = time.monotonic()
+        bucket = self.packet_in_buckets.get(dpid)
+        if bucket is None:
+            bucket = self.packet_in_buckets[dpid] = [float(self.packet_in_burst), now]
+        tokens = min(self.packet_in_burst, bucket[0] + (now - bucket[1]) * self.packet_in_rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def _packet_in_worker(self):
+        """
+        Green thread processing the queued packet-ins, one per datapath at a time so that a flooding
+        switch cannot starve the others, and yielding between rounds to keep the event loop responsive
+        """
+        while True:
+            self.packet_in_ready.wait()
+            self.packet_in_ready.clear()
+            pending = True
+            while pending:
+                pending = False
+                for queue in list(self.packet_in_queues.values()):
+                    if not queue:
+                        continue
+                    msg, ethertype = queue.popleft()
+                    pending = pending or bool(queue)
+                    try:
+                        self.process_packet_in(msg, ethertype)
+                    except Exception:
+                        self.logger.exception("failed to process packet-in from switch%s", msg.datapath.id)
+                hub.sleep(0)
+
+    def process_packet_in(self, msg, ethertype):
+        """
+        Function for processing an admitted ARP or IPv4 packet-in
+        Parameters:
+            msg: the OFPPacketIn message
+            ethertype: the ethertype already read from the frame
+        Returns:
+            None
         """
         self.logger.debug("packet received!")
-        if ev.msg.msg_len < ev.msg.total_len: #check if the packet is truncated
+        if msg.msg_len < msg.total_len: #check if the packet is truncated
             self.logger.debug("packet truncated: only %s of %s bytes",
-                            ev.msg.msg_len, ev.msg.total_len)
-        msg = ev.msg
+                            msg.msg_len, msg.total_len)
+        data = msg.data
         datapath = msg.datapath
-        in_port = msg.in_port
-
-        
-        
+        if datapath.ofproto.OFP_VERSION == ofproto_v1_3.OFP_VERSION:
+            in_port = msg.match['in_port']
+        else:
+            in_port = msg.in_port
 
-        pkt = packet.Packet(msg.data)
+        pkt = packet.Packet(data)
         eth = pkt.get_protocols(ethernet.ethernet)[0]
         src=eth.src
-        
-
 
-        if eth.ethertype == ether_types.ETH_TYPE_LLDP:
-            # Ignore LLDP packet: ignoring the link layer discovery packets from the switches
-            return
-        if eth.ethertype == ether_types.ETH_TYPE_ARP:
+        if ethertype == ether_types.ETH_TYPE_ARP:
+            self.packet_in_stats["arp"] += 1
             arp_packet = pkt.get_protocol(arp.arp)
             if arp_packet:
                 if arp_packet.opcode == arp.ARP_REQUEST:
                     # Handle ARP request
-                    self.logger.info("Received ARP request from %s for %s", src, arp_packet.dst_ip)
+                    self.logger.debug("Received ARP request from %s for %s", src, arp_packet.dst_ip)
                     # calling the handle_arp_request function to generate an ARP reply
-                    res=self.handle_arp_request(datapath, in_port, eth, arp_packet)
-                    
-
-
-
+                    self.handle_arp_request(datapath, in_port, eth, arp_packet)
                 elif arp_packet.opcode == arp.ARP_REPLY:
                     # Handle ARP reply (just printing that is actually received by the sender)
-                    self.logger.info("Received ARP reply from %s", src)
-                    
-             
+                    self.arp_stats["replies_received"] += 1
+                    self.logger.debug("Received ARP reply from %s", src)
+            return
 
+        self.packet_in_stats["ipv4"] += 1
         dst = eth.dst
-        src = eth.src
 
         dpid = datapath.id
         dst_dpid = self.tm.dpid_hostLookup(dst)
@@ -335,108 +925,550 @@ class ShortestPathSwitching(app_manager.RyuApp):
         if dst_dpid is not None:
             self.logger.info("packet in %s %s %s %s %s", dpid, src, dst, dst_dpid, in_port)
 
+        if self.reactive_mode:
+            ip_packet = pkt.get_protocol(ipv4.ipv4)
+            if ip_packet is not None:
+                self.handle_reactive_packet(datapath, in_port, msg, ip_packet.src, ip_packet.dst)
 
-                                        
-                                
-                            
-
+    def handle_reactive_packet(self, datapath, in_port, msg, src_ip, dst_ip):
+        """
+        Function for setting up the path of a host pair on its first IPv4 packet-in.
+        Packet-ins of the same pair arriving while the setup is in flight only wait for it
+        Parameters:
+            datapath: the datapath that sent the packet-in
+            in_port: the port the packet came from
+            msg: the OFPPacketIn message, released once the rules are confirmed
+            src_ip: source ip address of the packet
+            dst_ip: destination ip address of the packet
+        Returns:
+            None
+        """
+        if src_ip not in self.tm.host_ip_lookup or dst_ip not in self.tm.host_ip_lookup:
+            self.reactive_stats["unknown_hosts"] += 1
+            return
+        key = frozenset((src_ip, dst_ip))
+        waiting = self.pending_setups.get(key)
+        if waiting is not None:
+            waiting.append((datapath, in_port, msg))
+            self.reactive_stats["coalesced"] += 1
+            return
+        self.pending_setups[key] = [(datapath, in_port, msg)]
+        self.reactive_stats["setups"] += 1
+        hub.spawn(self._reactive_setup, key, src_ip, dst_ip)
 
-    def handle_arp_request(self, datapath, in_port, eth, arp_packet):
-        # Check if the destination IP is in your topology manager's hosts
-        if arp_packet.dst_ip in self.tm.host_ip_lookup:
-            dst_mac = self.tm.host_ip_lookup[arp_packet.dst_ip]
-            self.logger.info(f"Received ARP request for {arp_packet.dst_ip} from {arp_packet.src_ip}")
-            self.logger.info(f"Sending ARP reply to {arp_packet.src_ip} with MAC address: {dst_mac}")
-            # Update the ARP reply packet with the correct MAC address
-            arp_reply = arp.arp(
-                opcode=arp.ARP_REPLY,
-                src_mac=dst_mac,
-                src_ip=arp_packet.dst_ip,
-                dst_mac=arp_packet.src_mac,
-                dst_ip=arp_packet.src_ip
-            )
-            eth_reply = ethernet.ethernet(
-                ethertype=ether_types.ETH_TYPE_ARP,
-                src=dst_mac,
-                dst=arp_packet.src_mac
-            )
-            pkt = packet.Packet()
-            pkt.add_protocol(eth_reply)
-            pkt.add_protocol(arp_reply)
-            pkt.serialize()
-
-            # Send the ARP reply packet out
-            ofproto = datapath.ofproto
-            parser = datapath.ofproto_parser
-            actions = [parser.OFPActionOutput(in_port)]
-            out = parser.OFPPacketOut(
-                datapath=datapath,
-                buffer_id=ofproto.OFP_NO_BUFFER,
-                in_port=ofproto.OFPP_CONTROLLER,
-                actions=actions,
-                data=pkt.data
-            )
-            datapath.send_msg(out)
-            
-        else:
-            # If the destination IP is not known in the network, you can either flood the ARP request
-            # or drop it. Here, I will simply drop the ARP request.
+    def _reactive_setup(self, key, src_ip, dst_ip):
+        """
+        Green thread installing the rules of a host pair, then releasing the packets that waited for them.
+        Runs outside of the event handlers since it waits for the barrier replies
+        """
+        try:
+            confirmed = self.set_up_rules(src_ip, dst_ip, wait=True)
+        except Exception:
+            self.logger.exception(f"reactive setup between {src_ip} and {dst_ip} failed")
+            confirmed = False
+        waiting = self.pending_setups.pop(key, [])
+        # Without rules the released packets would only come back to the controller
+        installed = self.forwarding_mode == "destination" or (src_ip, dst_ip) in self.tm.installed_paths
+        if not confirmed or not installed:
+            self.reactive_stats["failed"] += 1
+            self.logger.warn(f"no rules between {src_ip} and {dst_ip}: dropping {len(waiting)} packets")
             return
+        for datapath, in_port, msg in waiting:
+            self.release_packet(datapath, in_port, msg)
+        self.reactive_stats["released"] += len(waiting)
+
+    def release_packet(self, datapath, in_port, msg):
+        """
+        Function for sending a packet that reached the controller back through the flow table of its switch
+        Parameters:
+            datapath: the datapath holding the packet
+            in_port: the port the packet came from
+            msg: the OFPPacketIn message, its buffer is released if the switch buffered the packet
+        Returns:
+            None
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        actions = [parser.OFPActionOutput(ofproto.OFPP_TABLE)]
+        data = msg.data if msg.buffer_id == ofproto.OFP_NO_BUFFER else None
+        out = parser.OFPPacketOut(
+            datapath=datapath,
+            buffer_id=msg.buffer_id,
+            in_port=in_port,
+            actions=actions,
+            data=data
+        )
+        datapath.send_msg(out)
 
+    def build_arp_template(self, ip, mac):
+        """
+        Function for prebuilding the ARP reply announcing a host, so that answering a request is a byte patch
+        Parameters:
+            ip: the ip address of the host
+            mac: the mac address of the host
+        Returns:
+            the template, a bytearray whose requester fields (ethernet destination, target mac and ip) are blank
+        """
+        eth_reply = ethernet.ethernet(
+            ethertype=ether_types.ETH_TYPE_ARP,
+            src=mac,
+            dst="00:00:00:00:00:00"
+        )
+        arp_reply = arp.arp(
+            opcode=arp.ARP_REPLY,
+            src_mac=mac,
+            src_ip=ip,
+            dst_mac="00:00:00:00:00:00",
+            dst_ip="0.0.0.0"
+        )
+        pkt = packet.Packet()
+        pkt.add_protocol(eth_reply)
+        pkt.add_protocol(arp_reply)
+        pkt.serialize()
+        template = bytearray(pkt.data)
+        self.arp_templates[ip] = (mac, template)
+        return template
 
+    def handle_arp_request(self, datapath, in_port, eth, arp_packet):
+        """
+        Function for answering an ARP request on behalf of a known host, the request never reaches the other hosts
+        Parameters:
+            datapath: the datapath that punted the request
+            in_port: the port the request came from
+            eth: the ethernet header of the request
+            arp_packet: the ARP header of the request
+        Returns:
+            True if a reply was sent, False if the target is unknown
+        """
+        self.arp_stats["requests"] += 1
+        # Check if the destination IP is in your topology manager's hosts
+        dst_mac = self.tm.host_ip_lookup.get(arp_packet.dst_ip)
+        if dst_mac is None:
+            # If the destination IP is not known in the network the request is dropped
+            self.arp_stats["unknown_targets"] += 1
+            return False
+
+        cached = self.arp_templates.get(arp_packet.dst_ip)
+        template = cached[1] if cached is not None and cached[0] == dst_mac else \
+            self.build_arp_template(arp_packet.dst_ip, dst_mac)
+        self.logger.debug(f"Sending ARP reply to {arp_packet.src_ip} with MAC address: {dst_mac}")
+
+        # Only the requester fields change between two replies announcing the same host
+        requester_mac = addrconv.mac.text_to_bin(arp_packet.src_mac)
+        data = bytearray(template)
+        data[0:6] = requester_mac                                          # ethernet destination
+        data[32:38] = requester_mac                                        # ARP target mac
+        data[38:42] = addrconv.ipv4.text_to_bin(arp_packet.src_ip)         # ARP target ip
+
+        # Send the ARP reply packet out
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        actions = [parser.OFPActionOutput(in_port)]
+        out = parser.OFPPacketOut(
+            datapath=datapath,
+            buffer_id=ofproto.OFP_NO_BUFFER,
+            in_port=ofproto.OFPP_CONTROLLER,
+            actions=actions,
+            data=bytes(data)
+        )
+        datapath.send_msg(out)
+        self.arp_stats["replies_sent"] += 1
+        return True
 
-        
-    def add_flow(self, datapath, match, actions):
+    def add_flow(self, datapath, match, actions, batch=None, priority=None):
         """
         Function for adding flows on a given datapath, match and actions.
         Parameters:
             datapath: the datapath on which we are going to set the rules
             match: the object containing the in_port to match
             actions: the object containing the out_port to forward to
+            batch: if given, the flow mod is queued in it and sent later by send_batch
+            priority: the priority of the flow, OFP_DEFAULT_PRIORITY if not given
         Returns:
             None
         """
-        ofproto = ofproto_v1_0
-        parser = ofproto_v1_0_parser
+        ofproto = datapath.ofproto
 
-        flow_mod = parser.OFPFlowMod(
-            datapath=datapath, match=match, cookie=0,
-            command=ofproto.OFPFC_ADD, idle_timeout=0, hard_timeout=0,
-            priority=ofproto.OFP_DEFAULT_PRIORITY,
+        flow_mod = self.build_flow_mod(
+            datapath, match, ofproto.OFPFC_ADD,
+            ofproto.OFP_DEFAULT_PRIORITY if priority is None else priority,
             actions=actions,
-             
+            idle_timeout=self.get_flow_idle_timeout(),
+            hard_timeout=self.flow_hard_timeout
         )
-        datapath.send_msg(flow_mod)
-    
-    def check_rule(self, switch, in_port, out_port):
-         existing_rule=self.tm.get_rule_from_dict(switch,in_port)
-         if existing_rule is not None and (existing_rule!=out_port):
-              self.logger.warn(f"found already existing rule on in_port:{in_port} for switch:{switch} on out_port:{existing_rule}")
-              del self.tm.flow_rules[switch]
-              self.delete_flow_rule(self.tm.get_device_by_name(switch).get_dp(),in_port)
-         existing_rule=self.tm.get_rule_from_dict(switch,out_port)
-         if existing_rule is not None and (existing_rule!=in_port):
-              self.logger.warn(f"found already existing rule on in_port:{out_port} for switch:{switch} on out_port:{existing_rule}")
-              del self.tm.flow_rules[switch]
-              self.delete_flow_rule(self.tm.get_device_by_name(switch).get_dp(),out_port)
-
-    def delete_flow_rule(self, datapath, in_port):
+        self.send_or_queue(datapath, flow_mod, batch)
+
+    def get_flow_idle_timeout(self):
+        """
+        Function for getting the idle timeout of the forwarding rules.
+        By default only the rules that reactive_mode installs again on demand expire
+        Parameters:
+            None
+        Returns:
+            the idle timeout in seconds, 0 for no timeout
+        """
+        if self.flow_idle_timeout is None:
+            return 300 if self.reactive_mode else 0
+        return self.flow_idle_timeout
+
+    def send_or_queue(self, datapath, msg, batch=None):
+        """
+        Function for sending a message to a datapath right away, or queueing it in a batch for send_batch
+        Parameters:
+            datapath: the datapath the message is for
+            msg: the OpenFlow message
+            batch: if given, the message is queued in it
+        Returns:
+            None
+        """
+        if batch is not None:
+            batch.setdefault(datapath.id, (datapath, []))[1].append(msg)
+        else:
+            datapath.send_msg(msg)
+
+    def build_match(self, datapath, in_port=None, src_mac=None, dst_mac=None):
+        """
+        Function for building a match on in_port, source and destination mac, for the datapath's OpenFlow version
+        Parameters:
+            datapath: the datapath the match is for
+            in_port: the input port to match, None to leave it wildcarded
+            src_mac: the source mac to match, None to leave it wildcarded
+            dst_mac: the destination mac to match, None to leave it wildcarded
+        Returns:
+            an OFPMatch instance
+        """
+        parser = datapath.ofproto_parser
+        fields = {}
+        if in_port is not None:
+            fields['in_port'] = in_port
+        if datapath.ofproto.OFP_VERSION == ofproto_v1_3.OFP_VERSION:
+            if src_mac is not None:
+                fields['eth_src'] = src_mac
+            if dst_mac is not None:
+                fields['eth_dst'] = dst_mac
+        else:
+            if src_mac is not None:
+                fields['dl_src'] = src_mac
+            if dst_mac is not None:
+                fields['dl_dst'] = dst_mac
+        return parser.OFPMatch(**fields)
+
+    def build_flow_mod(self, datapath, match, command, priority, actions=None, table_id=None,
+                       idle_timeout=0, hard_timeout=0):
+        """
+        Function for building a flow mod for the datapath's OpenFlow version.
+        On OpenFlow 1.3 the flow goes in the forwarding table unless another table is given
+        Parameters:
+            datapath: the datapath the flow mod is for
+            match: the OFPMatch of the flow
+            command: the OFPFC_* command
+            priority: the priority of the flow
+            actions: the actions applied by the flow, if any
+            table_id: the OpenFlow 1.3 table of the flow
+            idle_timeout, hard_timeout: the timeouts of the flow, a flow with a timeout is reported when removed
+        Returns:
+            an OFPFlowMod instance
+        """
         ofproto = datapath.ofproto
         parser = datapath.ofproto_parser
+        flags = ofproto.OFPFF_SEND_FLOW_REM if idle_timeout or hard_timeout else 0
+        if ofproto.OFP_VERSION == ofproto_v1_3.OFP_VERSION:
+            instructions = []
+            if actions:
+                instructions.append(parser.OFPInstructionActions(ofproto.OFPIT_APPLY_ACTIONS, actions))
+            return parser.OFPFlowMod(
+                datapath=datapath, cookie=0,
+                table_id=self.FORWARDING_TABLE if table_id is None else table_id,
+                command=command, idle_timeout=idle_timeout, hard_timeout=hard_timeout,
+                priority=priority, flags=flags,
+                out_port=ofproto.OFPP_ANY, out_group=ofproto.OFPG_ANY,
+                match=match, instructions=instructions
+            )
+        return parser.OFPFlowMod(
+            datapath=datapath, match=match, cookie=0,
+            command=command, idle_timeout=idle_timeout, hard_timeout=hard_timeout,
+            priority=priority, flags=flags, actions=actions or []
+        )
 
-        # Create a match for the existing rule based on in_port and out_port
+    @set_ev_cls(ofp_event.EventOFPSwitchFeatures, CONFIG_DISPATCHER)
+    def _switch_features_handler(self, ev):
+        """
+        Event handler for the switch handshake: punts ARP to the controller and sets up the OpenFlow 1.3 pipeline.
+        The classifier table punts ARP to the controller and sends everything else to the forwarding table,
+        whose misses reach the controller like on OpenFlow 1.0
+        """
+        datapath = ev.msg.datapath
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        if ofproto.OFP_VERSION != ofproto_v1_3.OFP_VERSION:
+            # ARP goes to the controller proxy even when a forwarding rule matches the hosts of the frame
+            arp_match = parser.OFPMatch(dl_type=ether_types.ETH_TYPE_ARP)
+            to_controller = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER)]
+            datapath.send_msg(self.build_flow_mod(datapath, arp_match, ofproto.OFPFC_ADD,
+                                                  self.arp_priority, to_controller))
+            return
 
-        # Create a flow mod message to delete the rule
-        flow_mod = parser.OFPFlowMod(
-            datapath=datapath,
-            command=ofproto.OFPFC_DELETE,
-            match=parser.OFPMatch()
+        to_controller = [parser.OFPActionOutput(ofproto.OFPP_CONTROLLER, ofproto.OFPCML_NO_BUFFER)]
+        arp_match = parser.OFPMatch(eth_type=ether_types.ETH_TYPE_ARP)
+        datapath.send_msg(self.build_flow_mod(datapath, arp_match, ofproto.OFPFC_ADD, 1,
+                                              to_controller, self.CLASSIFIER_TABLE))
+        datapath.send_msg(parser.OFPFlowMod(
+            datapath=datapath, table_id=self.CLASSIFIER_TABLE, priority=0, match=parser.OFPMatch(),
+            instructions=[parser.OFPInstructionGotoTable(self.FORWARDING_TABLE)]
+        ))
+        datapath.send_msg(self.build_flow_mod(datapath, parser.OFPMatch(), ofproto.OFPFC_ADD, 0, to_controller))
+
+    def install_group(self, datapath, group_id, group_type, buckets, batch=None):
+        """
+        Function for adding or modifying an OpenFlow 1.3 group
+        Parameters:
+            datapath: the datapath holding the group
+            group_id: the id of the group
+            group_type: OFPGT_SELECT or OFPGT_FF
+            buckets: list of (output port, watched port) pairs, the watched port is ignored by SELECT groups
+            batch: if given, the group mod is queued in it
+        Returns:
+            None
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        if group_type == ofproto.OFPGT_SELECT:
+            ofp_buckets = [parser.OFPBucket(weight=1, actions=[parser.OFPActionOutput(port)])
+                           for port, _ in buckets]
+        else:
+            ofp_buckets = [parser.OFPBucket(watch_port=watch, actions=[parser.OFPActionOutput(port)])
+                           for port, watch in buckets]
+        key = (datapath.id, group_id)
+        command = ofproto.OFPGC_MODIFY if key in self.installed_groups else ofproto.OFPGC_ADD
+        self.installed_groups.add(key)
+        group_mod = parser.OFPGroupMod(datapath, command, group_type, group_id, ofp_buckets)
+        self.send_or_queue(datapath, group_mod, batch)
+
+    def delete_group(self, datapath, group_id, batch=None):
+        """
+        Function for deleting an OpenFlow 1.3 group
+        Parameters:
+            datapath: the datapath holding the group
+            group_id: the id of the group
+            batch: if given, the group mod is queued in it
+        Returns:
+            None
+        """
+        ofproto = datapath.ofproto
+        parser = datapath.ofproto_parser
+        self.installed_groups.discard((datapath.id, group_id))
+        group_mod = parser.OFPGroupMod(datapath, ofproto.OFPGC_DELETE, ofproto.OFPGT_ALL, group_id)
+        self.send_or_queue(datapath, group_mod, batch)
+
+    def send_batch(self, batch, wait=False):
+        """
+        Function for sending the flow mods queued by add_flow, each datapath in one burst closed by a barrier
+        Parameters:
+            batch: dictionary dpid -> (datapath, list of messages) filled by add_flow
+            wait: True to block until every barrier reply has arrived
+        Returns:
+            True if the batch has been sent (and confirmed, when waiting), False on timeout
+        """
+        barriers=self.post_batch(batch, track=wait)
+        return self.wait_barriers(batch, barriers)
+
+    def post_batch(self, batch, track=False):
+        """
+        Function for sending a batch right away, without waiting for the switches
+        Parameters:
+            batch: dictionary dpid -> (datapath, list of messages) filled by add_flow
+            track: True to register the barriers so that wait_barriers can wait for their replies
+        Returns:
+            the list of ((dpid, xid), hub.Event) of the tracked barriers
+        """
+        barriers=[]
+        for dpid, (datapath, msgs) in batch.items():
+            for msg in msgs:
+                datapath.send_msg(msg)
+            barrier=datapath.ofproto_parser.OFPBarrierRequest(datapath)
+            datapath.set_xid(barrier)
+            if track:
+                done=hub.Event()
+                self.pending_barriers[(dpid, barrier.xid)]=done
+                barriers.append(((dpid, barrier.xid), done))
+            datapath.send_msg(barrier)
+        return barriers
+
+    def wait_barriers(self, batch, barriers):
+        """
+        Function for waiting the replies of the barriers tracked by post_batch.
+        Must not be called from a Ryu event handler, which would never see the replies
+        Parameters:
+            batch: the batch the barriers closed
+            barriers: the list returned by post_batch
+        Returns:
+            True if every switch replied within barrier_timeout, False otherwise
+        """
+        start=time.time()
+        confirmed=True
+        for key, done in barriers:
+            remaining=max(self.barrier_timeout-(time.time()-start), 0)
+            if not done.wait(timeout=remaining):
+                self.logger.warn(f"no barrier reply from switch {key[0]} within {self.barrier_timeout}s")
+                confirmed=False
+            self.pending_barriers.pop(key, None)
+        if barriers and confirmed:
+            self.logger.info(f"{sum(len(msgs) for _, msgs in batch.values())} flow mods confirmed "
+                             f"on {len(barriers)} switches in {time.time()-start:.3f}s")
+        return confirmed
+
+    @set_ev_cls(ofp_event.EventOFPBarrierReply, MAIN_DISPATCHER)
+    def _barrier_reply_handler(self, ev):
+        """
+        Event handler for the barrier replies: wakes up the send_batch call waiting for them
+        """
+        done=self.pending_barriers.pop((ev.msg.datapath.id, ev.msg.xid), None)
+        if done is not None:
+            done.set()
+
+    @set_ev_cls(ofp_event.EventOFPFlowRemoved, MAIN_DISPATCHER)
+    def _flow_removed_handler(self, ev):
+        """
+        Event handler for the expired flows: forgets the rule, and a host pair once none of its rules is left.
+        The directions of a pair expire on their own, so one way traffic keeps its rules.
+        In proactive mode an expired destination rule is installed again.
+        The flows deleted by the controller itself are already forgotten and are ignored
+        """
+        msg = ev.msg
+        datapath = msg.datapath
+        ofproto = datapath.ofproto
+        if msg.reason not in (ofproto.OFPRR_IDLE_TIMEOUT, ofproto.OFPRR_HARD_TIMEOUT):
+            return
+        in_port, src_mac, dst_mac = self.get_match_fields(datapath, msg.match)
+        switch = str(datapath.id)
+
+        if msg.priority == self.destination_priority and src_mac is None:
+            out_port = self.tm.remove_dst_rule(switch, dst_mac)
+            self.logger.info(f"destination rule towards {dst_mac} expired on switch{switch}")
+            if isinstance(out_port, tuple) and (datapath.id, self.group_ids.get(dst_mac)) in self.installed_groups:
+                self.delete_group(datapath, self.group_ids[dst_mac])
+            if self.proactive_mode and dst_mac in self.tm.host_mac_lookup:
+                self.install_destination_tree(dst_mac)
+            return
+
+        if self.tm.remove_rule_from_dict(switch, in_port, src_mac, dst_mac) is None:
+            return
+        self.logger.info(f"rule {src_mac} -> {dst_mac} on in_port:{in_port} expired on switch{switch}")
+        src_host = self.tm.host_mac_lookup.get(src_mac)
+        dst_host = self.tm.host_mac_lookup.get(dst_mac)
+        if src_host is None or dst_host is None:
+            return
+        pairs = [(src_ip, dst_ip) for src_ip in src_host.get_ips() for dst_ip in dst_host.get_ips()]
+        pair = next((pair for pair in pairs + [pair[::-1] for pair in pairs] if pair in self.tm.installed_paths), None)
+        path = self.tm.installed_paths.get(pair)
+        if path is not None and not any(self.tm.get_pair_rules(sw, src_mac, dst_mac) for sw in path):
+            # Both directions expired everywhere: nothing is left to reprogram for the pair
+            self.tm.unregister_path(pair)
+            self.logger.info(f"path between {pair[0]} and {pair[1]} expired")
+
+    def get_match_fields(self, datapath, match):
+        """
+        Function for reading in_port, source and destination mac back from a match built by build_match
+        Parameters:
+            datapath: the datapath the match comes from
+            match: the OFPMatch
+        Returns:
+            (in_port, src_mac, dst_mac), None for the wildcarded fields
+        """
+        if datapath.ofproto.OFP_VERSION == ofproto_v1_3.OFP_VERSION:
+            return match.get('in_port'), match.get('eth_src'), match.get('eth_dst')
+        wildcards = match.wildcards
+        ofproto = datapath.ofproto
+        in_port = None if wildcards & ofproto.OFPFW_IN_PORT else match.in_port
+        src_mac = None if wildcards & ofproto.OFPFW_DL_SRC else addrconv.mac.bin_to_text(match.dl_src)
+        dst_mac = None if wildcards & ofproto.OFPFW_DL_DST else addrconv.mac.bin_to_text(match.dl_dst)
+        return in_port, src_mac, dst_mac
+    
+    def check_rule(self, switch, in_port, out_port, src_mac, dst_mac, batch=None):
+        """
+        Function for deleting the flows of a host pair on a switch that disagree with the ports being installed
+        Parameters:
+            switch: the dpid of the switch
+            in_port: the port facing the source host
+            out_port: the port facing the destination host
+            src_mac: mac address of the source host
+            dst_mac: mac address of the destination host
+            batch: if given, the deletions are queued in it, see add_flow
+        Returns:
+            None
+        """
+        for rule_in, rule_src, rule_dst, expected in ((in_port, src_mac, dst_mac, out_port),
+                                                      (out_port, dst_mac, src_mac, in_port)):
+            existing_rule=self.tm.get_rule_from_dict(switch,rule_in,rule_src,rule_dst)
+            if existing_rule is not None and existing_rule!=expected:
+                self.logger.warn(f"found already existing rule on in_port:{rule_in} for switch:{switch} on out_port:{existing_rule}")
+                self.tm.remove_rule_from_dict(switch,rule_in,rule_src,rule_dst)
+                self.delete_flow_rule(self.tm.get_device_by_name(switch).get_dp(),rule_in,rule_src,rule_dst,batch)
+
+    def delete_flow_rule(self, datapath, in_port, src_mac, dst_mac, batch=None):
+        """
+        Function for deleting exactly the flow matching in_port, dl_src and dl_dst, leaving the other flows untouched
+        Parameters:
+            datapath: the datapath holding the flow
+            in_port: the in_port of the flow match
+            src_mac: the dl_src of the flow match
+            dst_mac: the dl_dst of the flow match
+            batch: if given, the flow mod is queued in it and sent later by send_batch
+        Returns:
+            None
+        """
+        ofproto = datapath.ofproto
+
+        # Create a flow mod message to delete the rule: strict deletion also requires the same priority
+        flow_mod = self.build_flow_mod(
+            datapath,
+            self.build_match(datapath,in_port=in_port,src_mac=src_mac,dst_mac=dst_mac),
+            ofproto.OFPFC_DELETE_STRICT,
+            ofproto.OFP_DEFAULT_PRIORITY
         )
 
         # Send the flow mod message to the switch
-        datapath.send_msg(flow_mod)
+        self.send_or_queue(datapath, flow_mod, batch)
 
-        
+    def delete_destination_rule(self, datapath, dst_mac, batch=None):
+        """
+        Function for deleting exactly the destination based flow for dst_mac
+        Parameters:
+            datapath: the datapath holding the flow
+            dst_mac: the dl_dst of the flow match
+            batch: if given, the flow mod is queued in it and sent later by send_batch
+        Returns:
+            None
+        """
+        ofproto = datapath.ofproto
+
+        flow_mod = self.build_flow_mod(
+            datapath,
+            self.build_match(datapath,dst_mac=dst_mac),
+            ofproto.OFPFC_DELETE_STRICT,
+            self.destination_priority
+        )
+        self.send_or_queue(datapath, flow_mod, batch)
+        if (datapath.id, self.group_ids.get(dst_mac)) in self.installed_groups:
+            self.delete_group(datapath, self.group_ids[dst_mac], batch)
+
+    def delete_pair_flows(self, src_mac, dst_mac, switches, batch=None):
+        """
+        Function for deleting, on the given switches, the flows installed for a host pair in both directions
+        Parameters:
+            src_mac: mac address of one host
+            dst_mac: mac address of the other host
+            switches: the dpids of the switches to clean up
+            batch: if given, the flow mods are queued in it, see add_flow
+        Returns:
+            None
+        """
+        for switch in switches:
+            device=self.tm.get_device_by_name(switch)
+            for in_port, rule_src, rule_dst in self.tm.get_pair_rules(switch, src_mac, dst_mac):
+                self.tm.remove_rule_from_dict(switch, in_port, rule_src, rule_dst)
+                if device is not None:
+                    self.delete_flow_rule(device.get_dp(), in_port, rule_src, rule_dst, batch)
 
     def delete_rules (self,src_host, dst_host):
         
@@ -444,18 +1476,19 @@ class ShortestPathSwitching(app_manager.RyuApp):
         dst_mac=self.tm.host_ip_lookup[dst_host]
         src_dpid=self.tm.dpid_hostLookup(src_mac)
         dst_dpid=self.tm.dpid_hostLookup(dst_mac)
-        parser=ofproto_v1_0_parser
 
         self.logger.info(f"Deleting rules between {src_host} and {dst_host}")
 
         if str(src_dpid) in self.tm.topo and str(dst_dpid) in self.tm.topo:
-            path=self.tm.get_shortest_path(str(src_dpid), str(dst_dpid))
+            # The installed path may differ from the current shortest path after a topology change
+            path=self.tm.unregister_path((src_host, dst_host))
+            if path is None:
+                path=self.get_pair_path(src_mac, dst_mac, src_dpid, dst_dpid)
 
             if path is not None and len(path)>=2:
-                for i in range(0,len(path)):
-                    self.delete_flow_rule(self.tm.get_device_by_name(path[i]).get_dp(),0)
-                    if path[i] in self.tm.flow_rules:
-                        del self.tm.flow_rules[path[i]]
+                batch={}
+                self.delete_pair_flows(src_mac, dst_mac, path, batch)
+                self.send_batch(batch)
 
 
 
@@ -1,6 +1,38 @@
 
 from ryu.controller.handler import CONFIG_DISPATCHER, MAIN_DISPATCHER 
+from collections import deque
+import zlib
 import networkx as nx
+import numpy as np
+
+# Capacity assumed for every link, in bit/s: OpenFlow 1.0 port stats do not report the link speed
+DEFAULT_LINK_CAPACITY = 1e9
+# Latency assumed for a link that has not been measured yet, in seconds
+DEFAULT_LINK_LATENCY = 1e-3
+
+
+def hop_cost(link):
+    """Every link costs the same: plain hop count"""
+    return 1
+
+
+def latency_cost(link):
+    """A link costs its latency, in seconds"""
+    return link.get("latency", DEFAULT_LINK_LATENCY)
+
+
+def bandwidth_cost(link):
+    """A link costs the inverse of its available bandwidth, normalized to its capacity"""
+    capacity = link.get("capacity", DEFAULT_LINK_CAPACITY)
+    available = max(capacity - link.get("utilization", 0.0), capacity * 1e-3)
+    return capacity / available
+
+
+COST_FUNCTIONS = {
+    "hops": hop_cost,
+    "latency": latency_cost,
+    "bandwidth": bandwidth_cost,
+}
 
 
 class Device():
@@ -94,7 +126,66 @@ class TopoManager():
         self.host_ip_lookup={}
         self.host_locate = {}
         self.flow_rules={}
+        self.dst_rules={}           # switch -> {dst_mac: out_port}, destination based forwarding rules
+        # Registry of the installed host pair paths, with reverse indexes to find the flows affected by an event
+        self.installed_paths = {}   # (src_ip, dst_ip) -> switch path
+        self.backup_paths = {}      # (src_ip, dst_ip) -> link-disjoint switch path, None if there is none
+        self.path_ports = {}        # (src_ip, dst_ip) -> (dpid, port_no) crossed by its path
+        self.port_flows = {}        # (dpid, port_no) -> set of (src_ip, dst_ip) whose path crosses the port
+        self.switch_flows = {}      # dpid -> set of (src_ip, dst_ip) whose path crosses the switch
+        self.endpoint_flows = {}    # (src dpid, dst dpid) -> set of (src_ip, dst_ip) between the two switches
         self.host_to_switch_port={}
+        # Lookup indexes over all_devices, so that device retrieval is O(1)
+        self.switch_lookup = {}     # dpid (str) -> TMSwitch
+        self.port_lookup = {}       # (dpid (str), port_no) -> device
+        self.host_mac_lookup = {}   # mac -> TMHost
+        # Shortest path cache, invalidated whenever the topology generation changes
+        self.topo_generation = 0
+        self.path_cache = {}        # (src, dst) -> path, also the ECMP path sets and the backup paths
+        self.path_cache_generation = 0
+        self.path_cache_hits = 0
+        self.path_cache_misses = 0
+        # All-pairs next-hop table over the switch fabric, used when next_hop_mode is enabled
+        self.next_hop_mode = False
+        self.dpid_index = {}        # dpid (str) -> row/column in next_hop
+        self.index_dpid = []        # row/column in next_hop -> dpid (str)
+        self.next_hop = np.empty((0, 0), dtype=np.int16)
+        self.hop_count = np.empty((0, 0), dtype=np.int16)
+        self.next_hop_generation = -1
+        # Link cost used by get_shortest_path, one of COST_FUNCTIONS
+        self.cost_function = "hops"
+        self.ecmp_max_paths = 16
+        self.port_neighbor = {}     # (dpid (str), port_no) -> dpid (str) of the switch on the other side
+        self.port_samples = {}      # (dpid (str), port_no) -> last (tx_bytes, timestamp)
+        self.port_rates = {}        # (dpid (str), port_no) -> transmitted bit/s
+
+    def bump_generation(self, fabric=True):
+        """
+        Function to be called by every mutator of the topology, so that cached paths get invalidated
+        Parameters:
+            fabric: False if the change does not touch the switches or the links between them,
+                    in which case an up to date next-hop table is kept valid
+        Returns:
+            the new topology generation
+        """
+        table_current = self.next_hop_generation == self.topo_generation
+        self.topo_generation += 1
+        if table_current and not fabric:
+            self.next_hop_generation = self.topo_generation
+        return self.topo_generation
+
+    def get_path_cache_stats(self):
+        """
+        Function for getting the counters of the path cache
+        Parameters:
+            None
+        Returns:
+            a dictionary with hits, misses, cached entries and topology generation
+        """
+        return {"hits": self.path_cache_hits,
+                "misses": self.path_cache_misses,
+                "entries": len(self.path_cache),
+                "generation": self.topo_generation}
 
     def add_switch(self, sw):
         """
@@ -111,8 +202,15 @@ class TopoManager():
         self.network_graph.add_node(str(sw.dp.id))
         self.gui_graph.add_node(str(sw.dp.id))
         dpid_str = str(sw.dp.id)
+        self.switch_lookup[dpid_str] = switch
+        for port in switch.get_ports():
+            self.port_lookup[(dpid_str, port.port_no)] = switch
+        table_current = self.next_hop_generation == self.topo_generation
         if dpid_str not in self.topo:
             self.topo[dpid_str] = {}
+        self.bump_generation()
+        if table_current:
+            self._extend_next_hop_table()
         print("Added switch node to network_graph:", sw.dp.id)
         print("Current network_graph nodes:",self.network_graph.nodes)
 
@@ -135,6 +233,9 @@ class TopoManager():
             host_ip=ip
 
         self.all_devices.append(host)
+        self.host_mac_lookup[h.mac] = host
+        # Switch ports take precedence over the hosts attached to them
+        self.port_lookup.setdefault((dpid, h.port.port_no), host)
         self.network_graph.add_node(name)
         self.network_graph.add_edge(dpid, name)
         self.gui_graph.add_edge(dpid,host_ip)
@@ -142,6 +243,7 @@ class TopoManager():
         switch_dpid=dpid
         port_no=h.port.port_no
         self.host_to_switch_port[h.mac]={switch_dpid:port_no}
+        self.bump_generation(fabric=False)
         print(f"current mapping of the hosts with switches:{self.host_to_switch_port}")
 
     def add_host_ip_mac_mapping(self, ip, mac):
@@ -164,10 +266,15 @@ class TopoManager():
             dst_switch: the destination switch of the link
             dst_port_no: the port number of the destination switch
         Returns:
-            None
+            the set of (src, dst) switch pairs whose shortest path changed: all of them when the next-hop table
+            gives the paths, otherwise the endpoints of the installed paths that the link makes shorter
         """
+        table_current = self.next_hop_generation == self.topo_generation
         src_switch=str(src_switch)
         dst_switch=str(dst_switch)
+        # The link may reference ports not known yet when the switch was added
+        self._index_link_port(src_switch, src_port_no)
+        self._index_link_port(dst_switch, dst_port_no)
         src_dev = self.get_device_by_port(src_switch, src_port_no)
         dst_dev = self.get_device_by_port(dst_switch, dst_port_no)
 
@@ -186,6 +293,9 @@ class TopoManager():
         # Add the link to the network graph
         self.network_graph.add_edge(src_switch, dst_switch)
         self.gui_graph.add_edge(src_switch,dst_switch)
+        self.port_neighbor[(src_switch, src_port_no)] = dst_switch
+        self.port_neighbor[(dst_switch, dst_port_no)] = src_switch
+        self._update_edge_weight(src_switch, dst_switch)
         
         # Add src_switch to self.topo if not present
         if src_switch not in self.topo:
@@ -198,12 +308,16 @@ class TopoManager():
         # Set ouput port in self.topo
         self.topo[src_switch][dst_switch] = src_port_no
         self.topo[dst_switch][src_switch] = dst_port_no
+        self.bump_generation()
 
-        
-
-
-
-        
+        if not self.next_hop_mode or self.cost_function != "hops":
+            # The next-hop table does not give the paths: it is built lazily once next_hop_mode is enabled
+            return self.get_pairs_shortened_by_link(src_switch, dst_switch)
+        if not table_current:
+            self.build_next_hop_table()
+            return self.get_pairs_shortened_by_link(src_switch, dst_switch)
+        self._extend_next_hop_table()
+        return self._update_spf_on_link_add(src_switch, dst_switch)
 
     def remove_link(self, link):
         """
@@ -211,18 +325,130 @@ class TopoManager():
         Parameters:
             link: the link to be removed
         Returns:
-            None
+            the set of (src, dst) switch pairs whose shortest path changed,
+            None if the next-hop table is not maintained (next_hop_mode off) or had to be rebuilt from scratch
         """
-        src_dev = self.get_device_by_port(link.src.dpid, link.src.port_no)
-        dst_dev = self.get_device_by_port(link.dst.dpid, link.dst.port_no)
+        src_switch = str(link.src.dpid)
+        dst_switch = str(link.dst.dpid)
+        src_dev = self.get_device_by_port(src_switch, link.src.port_no)
+        dst_dev = self.get_device_by_port(dst_switch, link.dst.port_no)
 
         if src_dev and dst_dev and isinstance(src_dev,TMSwitch) and isinstance(dst_dev,TMSwitch):
-            
-            src_switch=link.src.dpid
-            dst_switch=link.dst.dpid
-            self.network_graph.remove_edge(str(dst_switch),str(src_switch))
+            src_dev.neighbors.discard(dst_dev)
+            dst_dev.neighbors.discard(src_dev)
+
+        return self._remove_switch_link(src_switch, dst_switch)
+
+    def _remove_switch_link(self, src_switch, dst_switch):
+        """
+        Function for removing both directions of a link between two switches from every data structure
+        Parameters:
+            src_switch: dpid (str) of one endpoint of the link
+            dst_switch: dpid (str) of the other endpoint of the link
+        Returns:
+            the set of (src, dst) switch pairs whose shortest path changed when the next-hop table gives the paths,
+            otherwise an empty set: removing a link makes no path shorter, so only the paths crossing it have to move
+        """
+        table_current = self.next_hop_generation == self.topo_generation
 
         # Remove link from data structure(s)
+        if dst_switch not in self.topo.get(src_switch, {}):
+            # Already removed by the event for the opposite direction
+            return set()
+        if self.network_graph.has_edge(src_switch, dst_switch):
+            self.network_graph.remove_edge(src_switch, dst_switch)
+        if self.gui_graph.has_edge(src_switch, dst_switch):
+            self.gui_graph.remove_edge(src_switch, dst_switch)
+        src_port_no = self.topo[src_switch].pop(dst_switch)
+        dst_port_no = self.topo[dst_switch].pop(src_switch, None)
+        self.port_neighbor.pop((src_switch, src_port_no), None)
+        self.port_neighbor.pop((dst_switch, dst_port_no), None)
+        self.bump_generation()
+
+        if not self.next_hop_mode or self.cost_function != "hops":
+            return set()
+        if not table_current:
+            self.build_next_hop_table()
+            return set()
+        return self._update_spf_on_link_remove(src_switch, dst_switch)
+
+    def remove_host(self, mac):
+        """
+        Function for removing a host and its mappings from the topology manager
+        Parameters:
+            mac: the mac address of the host
+        Returns:
+            None
+        """
+        host = self.host_mac_lookup.pop(mac, None)
+        if host is None:
+            return
+        self.all_devices.remove(host)
+        dpid = str(host.get_port().dpid)
+        if self.port_lookup.get((dpid, host.get_port().port_no)) is host:
+            del self.port_lookup[(dpid, host.get_port().port_no)]
+        if self.network_graph.has_node(host.name):
+            self.network_graph.remove_node(host.name)
+        for ip in host.get_ips():
+            if self.gui_graph.has_node(ip):
+                self.gui_graph.remove_node(ip)
+            if self.host_ip_lookup.get(ip) == mac:
+                del self.host_ip_lookup[ip]
+        self.host_locate.pop(mac, None)
+        self.host_to_switch_port.pop(mac, None)
+        for rules in self.dst_rules.values():
+            rules.pop(mac, None)
+        self.dst_rules = {switch: rules for switch, rules in self.dst_rules.items() if rules}
+        self.bump_generation(fabric=False)
+
+    def remove_switch(self, sw):
+        """
+        Function for handling in the topology manager the remove switch event:
+        removes the switch, its links and the hosts attached to it from every data structure
+        Parameters:
+            sw: instance of the switch to be removed
+        Returns:
+            the set of (src, dst) switch pairs whose shortest path changed, see _remove_switch_link
+        """
+        dpid = str(sw.dp.id)
+        changed = set()
+        for nbr in list(self.topo.get(dpid, {})):
+            changed |= self._remove_switch_link(dpid, nbr)
+
+        for mac in [mac for mac, ports in self.host_to_switch_port.items() if dpid in ports]:
+            self.remove_host(mac)
+
+        switch = self.switch_lookup.pop(dpid, None)
+        if switch is not None:
+            self.all_devices.remove(switch)
+            for dev in self.all_devices:
+                dev.neighbors.discard(switch)
+        for key in [key for key in self.port_lookup if key[0] == dpid]:
+            del self.port_lookup[key]
+        if self.network_graph.has_node(dpid):
+            self.network_graph.remove_node(dpid)
+        if self.gui_graph.has_node(dpid):
+            self.gui_graph.remove_node(dpid)
+        self.topo.pop(dpid, None)
+        self.flow_rules.pop(dpid, None)
+        self.dst_rules.pop(dpid, None)
+        # The switch is isolated by now: its row and column of the next-hop table stay unreachable
+        self.bump_generation(fabric=False)
+        print("Removed switch node from network_graph:", dpid)
+        return changed
+
+    def _index_link_port(self, dpid, port_no):
+        """
+        Register in the port index a switch port seen on a link event
+        Parameters:
+            dpid: the dpid (str) of the switch owning the port
+            port_no: the port number on the switch
+        Returns:
+            None
+        """
+        switch = self.switch_lookup.get(dpid)
+        if switch is not None and not isinstance(self.port_lookup.get((dpid, port_no)), TMSwitch):
+            self.port_lookup[(dpid, port_no)] = switch
 
     def get_device_by_port(self, dpid, port_no):
         """
@@ -233,21 +459,17 @@ class TopoManager():
         Returns:
             an instance of the device found, None otherwise
         """
-        for dev in self.all_devices:
-            if isinstance(dev, TMSwitch):
-                for port in dev.get_ports():
-                    if port.port_no == port_no and dev.get_dpid() == dpid:
-                        return dev
-            elif isinstance(dev, TMHost) and port_no == dev.get_port().port_no:
-                return dev
-        return None
+        return self.port_lookup.get((str(dpid), port_no))
     
     def get_device_by_name(self, name):
-        name="switch_"+name
-        for dev in self.all_devices:
-            if isinstance (dev, TMSwitch):
-                if name==str(dev.name):
-                    return dev
+        """
+        Function for getting a switch by its dpid
+        Parameters:
+            name: the dpid of the switch
+        Returns:
+            the TMSwitch instance if found, None otherwise
+        """
+        return self.switch_lookup.get(str(name))
 
     def get_host_port_on_switch(self,host_mac,switch_dpid):
         if host_mac in self.host_to_switch_port and switch_dpid in self.host_to_switch_port[host_mac]:
@@ -258,6 +480,81 @@ class TopoManager():
             return None
 
 
+    def set_cost_function(self, name):
+        """
+        Function for selecting the link cost used by get_shortest_path
+        Parameters:
+            name: one of the keys of COST_FUNCTIONS
+        Returns:
+            None
+        """
+        if name not in COST_FUNCTIONS:
+            raise ValueError("unknown cost function {}, expected one of {}".format(name, list(COST_FUNCTIONS)))
+        self.cost_function = name
+        for src_switch, dst_switch in list(self.network_graph.edges):
+            if src_switch in self.topo and dst_switch in self.topo:
+                self._update_edge_weight(src_switch, dst_switch)
+        self.bump_generation(fabric=False)
+
+    def _update_edge_weight(self, src_switch, dst_switch):
+        """
+        Function for recomputing the weight of a switch to switch edge of network_graph
+        Parameters:
+            src_switch: dpid (str) of one endpoint of the link
+            dst_switch: dpid (str) of the other endpoint of the link
+        Returns:
+            True if the weight changed, False otherwise
+        """
+        link = self.network_graph.edges[src_switch, dst_switch]
+        ports = [(src_switch, self.topo.get(src_switch, {}).get(dst_switch)),
+                 (dst_switch, self.topo.get(dst_switch, {}).get(src_switch))]
+        # The busier direction of the link bounds the bandwidth left on it
+        link["utilization"] = max(self.port_rates.get(port, 0.0) for port in ports)
+        weight = COST_FUNCTIONS[self.cost_function](link)
+        changed = link.get("weight") != weight
+        link["weight"] = weight
+        return changed
+
+    def set_link_latency(self, src_switch, dst_switch, latency):
+        """
+        Function for recording the measured latency of a link
+        Parameters:
+            src_switch: dpid of one endpoint of the link
+            dst_switch: dpid of the other endpoint of the link
+            latency: the latency of the link, in seconds
+        Returns:
+            None
+        """
+        src_switch = str(src_switch)
+        dst_switch = str(dst_switch)
+        if self.network_graph.has_edge(src_switch, dst_switch):
+            self.network_graph.edges[src_switch, dst_switch]["latency"] = latency
+            if self._update_edge_weight(src_switch, dst_switch):
+                self.bump_generation(fabric=False)
+
+    def update_port_stats(self, dpid, port_no, tx_bytes, timestamp):
+        """
+        Function for feeding a port statistics sample, used to estimate the utilization of the links
+        Parameters:
+            dpid: the dpid of the switch
+            port_no: the port number on the switch
+            tx_bytes: the bytes transmitted on the port so far
+            timestamp: the time at which the sample was taken, in seconds
+        Returns:
+            None
+        """
+        key = (str(dpid), port_no)
+        previous = self.port_samples.get(key)
+        self.port_samples[key] = (tx_bytes, timestamp)
+        if previous is None or timestamp <= previous[1] or tx_bytes < previous[0]:
+            return
+        self.port_rates[key] = (tx_bytes - previous[0]) * 8 / (timestamp - previous[1])
+
+        neighbor = self.port_neighbor.get(key)
+        if neighbor is not None and self.network_graph.has_edge(key[0], neighbor):
+            if self._update_edge_weight(key[0], neighbor) and self.cost_function != "hops":
+                self.bump_generation(fabric=False)
+
     def get_shortest_path(self, src_switch, dst_switch):
         """
         Function for getting the shortest path between two switches
@@ -268,19 +565,182 @@ class TopoManager():
             a list containing the shortest path between src and dst
         """
         print(f"getting the shortest path from {src_switch} to {dst_switch}")
+        src_switch=str(src_switch)
+        dst_switch=str(dst_switch)
+        weighted = self.cost_function != "hops"
+        if self.next_hop_mode and not weighted:
+            return self.get_table_path(src_switch, dst_switch)
+        if self.path_cache_generation != self.topo_generation:
+            self.path_cache.clear()
+            self.path_cache_generation = self.topo_generation
+        key = (src_switch, dst_switch)
+        if key in self.path_cache:
+            self.path_cache_hits += 1
+            return self.path_cache[key]
+        self.path_cache_misses += 1
+
         try:
-            src_switch=str(src_switch)
-            dst_switch=str(dst_switch)
-            shortest_path = nx.shortest_path(self.network_graph, source=src_switch, target=dst_switch)
-            return shortest_path
+            if weighted:
+                shortest_path = nx.dijkstra_path(self.network_graph, src_switch, dst_switch, weight="weight")
+            else:
+                shortest_path = nx.shortest_path(self.network_graph, source=src_switch, target=dst_switch)
         except nx.NetworkXNoPath:
             print("Not finding any path...")
-            return None
+            shortest_path = None
         except nx.NodeNotFound:
             print("not founding any the nodes passed...")
-            return None
+            shortest_path = None
+        self.path_cache[key] = shortest_path
+        return shortest_path
         
     
+    def get_pairs_shortened_by_link(self, src_switch, dst_switch, ties=False):
+        """
+        Function for finding the installed paths that a new link makes shorter, with the current link cost.
+        A path from s to t through the link costs d(s, u) + w(u, v) + d(v, t) or d(s, v) + w(u, v) + d(u, t),
+        so one search from each endpoint of the link is enough, instead of a search per installed path
+        Parameters:
+            src_switch: dpid (str) of one endpoint of the new link
+            dst_switch: dpid (str) of the other endpoint of the new link
+            ties: True to also report the paths that the link only matches in cost, e.g. for ECMP
+        Returns:
+            the set of (src, dst) switch pairs of the installed paths to reconsider
+        """
+        if not self.endpoint_flows:
+            return set()
+        switches = self.network_graph.subgraph(self.topo.keys())
+        weighted = self.cost_function != "hops"
+        if weighted:
+            from_src = nx.single_source_dijkstra_path_length(switches, src_switch, weight="weight")
+            from_dst = nx.single_source_dijkstra_path_length(switches, dst_switch, weight="weight")
+            link_cost = switches.edges[src_switch, dst_switch].get("weight", 1)
+        else:
+            from_src = nx.single_source_shortest_path_length(switches, src_switch)
+            from_dst = nx.single_source_shortest_path_length(switches, dst_switch)
+            link_cost = 1
+
+        inf = float("inf")
+        changed = set()
+        for pair, path in self.installed_paths.items():
+            endpoints = (path[0], path[-1])
+            if endpoints in changed:
+                continue
+            if weighted:
+                links = list(zip(path, path[1:]))
+                if not all(self.network_graph.has_edge(*link) for link in links):
+                    changed.add(endpoints)
+                    continue
+                cost = sum(self.network_graph.edges[link].get("weight", 1) for link in links)
+            else:
+                cost = len(path) - 1
+            via_link = min(from_src.get(path[0], inf) + from_dst.get(path[-1], inf),
+                           from_dst.get(path[0], inf) + from_src.get(path[-1], inf)) + link_cost
+            if via_link < cost - 1e-9 or (ties and via_link <= cost + 1e-9):
+                changed.add(endpoints)
+        return changed
+
+    def get_disjoint_path(self, src_switch, dst_switch, avoid_links):
+        """
+        Function for getting the shortest path between two switches that does not cross the given links
+        Parameters:
+            src_switch: the source switch of our path
+            dst_switch: the destination switch of our path
+            avoid_links: iterable of (dpid, dpid) links to avoid, in either direction
+        Returns:
+            a list containing the path between src and dst, None if there is none
+        """
+        src_switch=str(src_switch)
+        dst_switch=str(dst_switch)
+        avoid = [(str(a), str(b)) for a, b in avoid_links]
+        view = nx.restricted_view(self.network_graph.subgraph(self.topo.keys()), [],
+                                  [link for link in avoid if self.network_graph.has_edge(*link)])
+        weight = "weight" if self.cost_function != "hops" else None
+        try:
+            return nx.shortest_path(view, source=src_switch, target=dst_switch, weight=weight)
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            return None
+
+    def get_backup_path(self, path, avoid_links=()):
+        """
+        Function for getting a backup for a switch path, sharing none of its links
+        Parameters:
+            path: the list of switches of the primary path
+            avoid_links: other (dpid, dpid) links the backup must not cross, e.g. a failed link still in the graph
+        Returns:
+            a list containing the link-disjoint backup path, None if there is none
+        """
+        if path is None or len(path) < 2:
+            return None
+        avoid_links = [(str(a), str(b)) for a, b in avoid_links]
+        if self.path_cache_generation != self.topo_generation:
+            self.path_cache.clear()
+            self.path_cache_generation = self.topo_generation
+        key = (tuple(path), "backup", frozenset(avoid_links))
+        if key in self.path_cache:
+            self.path_cache_hits += 1
+            return self.path_cache[key]
+        self.path_cache_misses += 1
+
+        backup = self.get_disjoint_path(path[0], path[-1], list(zip(path, path[1:])) + avoid_links)
+        self.path_cache[key] = backup
+        return backup
+
+    def get_equal_cost_paths(self, src_switch, dst_switch):
+        """
+        Function for getting all the equal-cost shortest paths between two switches, with the current link cost
+        Parameters:
+            src_switch: the source switch of our paths
+            dst_switch: the destination switch of our paths
+        Returns:
+            a sorted list of paths (at most ecmp_max_paths), None if there is no path
+        """
+        src_switch=str(src_switch)
+        dst_switch=str(dst_switch)
+        if self.path_cache_generation != self.topo_generation:
+            self.path_cache.clear()
+            self.path_cache_generation = self.topo_generation
+        key = (src_switch, dst_switch, "ecmp")
+        if key in self.path_cache:
+            self.path_cache_hits += 1
+            return self.path_cache[key]
+        self.path_cache_misses += 1
+
+        weight = "weight" if self.cost_function != "hops" else None
+        paths = []
+        try:
+            for path in nx.all_shortest_paths(self.network_graph, src_switch, dst_switch, weight=weight):
+                paths.append(path)
+                if len(paths) == self.ecmp_max_paths:
+                    break
+        except (nx.NetworkXNoPath, nx.NodeNotFound):
+            print(f"Not finding any path from {src_switch} to {dst_switch}...")
+        paths = sorted(paths) or None
+        self.path_cache[key] = paths
+        return paths
+
+    def get_ecmp_path(self, src_switch, dst_switch, src_mac, dst_mac):
+        """
+        Function for choosing, among the equal-cost shortest paths, the one carrying a host pair.
+        The choice is a deterministic hash of the pair, the same in both directions
+        Parameters:
+            src_switch: the switch of the source host
+            dst_switch: the switch of the destination host
+            src_mac: the mac address of the source host
+            dst_mac: the mac address of the destination host
+        Returns:
+            a list containing the chosen path between src and dst, None if there is none
+        """
+        # Enumerate the paths in a canonical direction, so both directions of a pair agree
+        src_switch, dst_switch = str(src_switch), str(dst_switch)
+        paths = self.get_equal_cost_paths(*sorted((src_switch, dst_switch)))
+        if not paths:
+            return None
+        key = "-".join(sorted((src_mac, dst_mac))).encode()
+        path = paths[zlib.crc32(key) % len(paths)]
+        if src_switch != path[0]:
+            path = path[::-1]
+        return path
+
     def dpid_hostLookup(self, mac):
         """
         Function for getting a host dpid by its mac address
@@ -289,9 +749,9 @@ class TopoManager():
         Returns:
             the host dpid if found, None otherwise
         """
-        for host in self.all_devices:
-            if isinstance(host, TMHost) and host.get_mac() == mac:
-                return (host.get_port().dpid)
+        host = self.host_mac_lookup.get(mac)
+        if host is not None:
+            return host.get_port().dpid
         return None
     
 
@@ -301,47 +761,476 @@ class TopoManager():
 
 
 
-    def get_output_port(self, src_switch, dst_switch):
+    def _fabric_adjacency(self):
         """
-        Function to retrieve the output port between a given src and dst
+        Function for getting the switch adjacency as lists of indexes of the next-hop table
+        Parameters:
+            None
+        Returns:
+            a list holding, for each switch index, the indexes of its neighbors
+        """
+        return [[self.dpid_index[nbr] for nbr in self.topo.get(dpid, {}) if nbr in self.dpid_index]
+                for dpid in self.index_dpid]
+
+    def _spf_column(self, dst, adjacency, old_next=None, edge_keys=None):
+        """
+        Function for computing the shortest path tree rooted at a destination switch with a BFS.
+        When the old tree is given, every node keeps its old next hop if that is still on a shortest path
+        Parameters:
+            dst: index of the destination switch
+            adjacency: the adjacency returned by _fabric_adjacency
+            old_next: the previous next-hop column for dst, if any
+            edge_keys: the sorted i * n + j keys of the links, required with old_next
+        Returns:
+            the next-hop column, the hop count column and the reachable nodes in BFS order
+        """
+        n = len(adjacency)
+        # The BFS runs on plain lists, indexing NumPy arrays element by element is much slower
+        hops = [-1] * n
+        next_col = [-1] * n
+        hops[dst] = 0
+        next_col[dst] = dst
+        order = [dst]
+        queue = deque([dst])
+        while queue:
+            node = queue.popleft()
+            depth = hops[node] + 1
+            for nbr in adjacency[node]:
+                if hops[nbr] == -1:
+                    hops[nbr] = depth
+                    next_col[nbr] = node
+                    order.append(nbr)
+                    queue.append(nbr)
+        hops = np.array(hops, dtype=self.hop_count.dtype)
+        next_col = np.array(next_col, dtype=self.next_hop.dtype)
+
+        if old_next is not None and len(order) > 1:
+            nodes = np.array(order[1:], dtype=np.int64)
+            old = old_next[nodes].astype(np.int64)
+            keep = (old != -1) & (old < n)
+            keep[keep] = hops[old[keep]] == hops[nodes[keep]] - 1
+            keep[keep] = np.isin(nodes[keep] * n + old[keep], edge_keys, assume_unique=True)
+            next_col[nodes[keep]] = old[keep]
+        return next_col, hops, order
+
+    def build_next_hop_table(self):
+        """
+        Function for (re)building the all-pairs next-hop table over the switches in self.topo.
+        next_hop[i, j] holds the index of the switch following i on a shortest path to j, -1 if unreachable
+        Parameters:
+            None
+        Returns:
+            None
+        """
+        self.index_dpid = list(self.topo.keys())
+        self.dpid_index = {dpid: i for i, dpid in enumerate(self.index_dpid)}
+        n = len(self.index_dpid)
+        dtype = np.int16 if n < np.iinfo(np.int16).max else np.int32
+        self.next_hop = np.full((n, n), -1, dtype=dtype)
+        self.hop_count = np.full((n, n), -1, dtype=dtype)
+        adjacency = self._fabric_adjacency()
+
+        # One BFS rooted at every destination: the parent of a node in the tree is its next hop
+        for dst in range(n):
+            self.next_hop[:, dst], self.hop_count[:, dst], _ = self._spf_column(dst, adjacency)
+
+        self.next_hop_generation = self.topo_generation
+
+    def _extend_next_hop_table(self):
+        """
+        Function for adding to an up to date next-hop table the switches that joined self.topo
+        Parameters:
+            None
+        Returns:
+            None
+        """
+        new_dpids = [dpid for dpid in self.topo if dpid not in self.dpid_index]
+        if new_dpids:
+            n = len(self.index_dpid) + len(new_dpids)
+            if n >= np.iinfo(self.next_hop.dtype).max:
+                self.build_next_hop_table()
+                return
+            for dpid in new_dpids:
+                self.dpid_index[dpid] = len(self.index_dpid)
+                self.index_dpid.append(dpid)
+            pad = ((0, len(new_dpids)), (0, len(new_dpids)))
+            self.next_hop = np.pad(self.next_hop, pad, constant_values=-1)
+            self.hop_count = np.pad(self.hop_count, pad, constant_values=-1)
+            for dpid in new_dpids:
+                i = self.dpid_index[dpid]
+                self.next_hop[i, i] = i
+                self.hop_count[i, i] = 0
+        self.next_hop_generation = self.topo_generation
+
+    def _recompute_spf_columns(self, destinations):
+        """
+        Function for recomputing the shortest path trees rooted at the given destinations
+        Parameters:
+            destinations: indexes of the destination switches whose tree is affected by a change
+        Returns:
+            the set of (src, dst) switch pairs whose shortest path changed
+        """
+        adjacency = self._fabric_adjacency()
+        n = len(adjacency)
+        edge_keys = np.array(sorted(i * n + j for i, nbrs in enumerate(adjacency) for j in nbrs), dtype=np.int64)
+        changed_pairs = set()
+        for dst in destinations:
+            old_next = self.next_hop[:, dst].copy()
+            next_col, hops, _ = self._spf_column(dst, adjacency, old_next, edge_keys)
+            self.next_hop[:, dst] = next_col
+            self.hop_count[:, dst] = hops
+
+            # A path changes if its first hop changes or the path from its first hop changes:
+            # the first hop changes are spread down the tree by pointer jumping
+            changed = next_col != old_next
+            changed[dst] = False
+            parent = np.where(next_col == -1, np.arange(n), next_col)
+            while True:
+                changed |= changed[parent]
+                grandparent = parent[parent]
+                if np.array_equal(grandparent, parent):
+                    break
+                parent = grandparent
+            dst_dpid = self.index_dpid[dst]
+            changed_pairs.update((self.index_dpid[src], dst_dpid) for src in np.flatnonzero(changed))
+
+        self.next_hop_generation = self.topo_generation
+        return changed_pairs
+
+    def _update_spf_on_link_add(self, src_switch, dst_switch):
+        """
+        Function for updating the next-hop table after a link has been added.
+        A new shortest path from x to t can only be x -> u -> v -> t or x -> v -> u -> t, so every column is
+        relaxed at once through the link; the pairs that get shorter are the only ones whose path changes
+        Parameters:
+            src_switch: dpid of one endpoint of the link
+            dst_switch: dpid of the other endpoint of the link
+        Returns:
+            the set of (src, dst) switch pairs whose shortest path changed
+        """
+        u = self.dpid_index[src_switch]
+        v = self.dpid_index[dst_switch]
+        n = len(self.index_dpid)
+        unreachable = 2 * n + 2
+        hops = self.hop_count.astype(np.int64)
+        hops[hops == -1] = unreachable
+
+        via_uv = hops[:, u, None] + 1 + hops[None, v, :]
+        via_vu = hops[:, v, None] + 1 + hops[None, u, :]
+        use_uv = via_uv <= via_vu
+        best = np.where(use_uv, via_uv, via_vu)
+        improved = best < hops
+
+        # First hop towards the near endpoint of the link, the link itself from that endpoint
+        towards_u = self.next_hop[:, u].copy()
+        towards_u[u] = v
+        towards_v = self.next_hop[:, v].copy()
+        towards_v[v] = u
+        new_next = np.where(use_uv, towards_u[:, None], towards_v[:, None])
+        self.next_hop[improved] = new_next[improved]
+        self.hop_count[improved] = best[improved]
+        self.next_hop_generation = self.topo_generation
+
+        srcs, dsts = np.nonzero(improved)
+        return {(self.index_dpid[i], self.index_dpid[j]) for i, j in zip(srcs.tolist(), dsts.tolist())}
+
+    def _update_spf_on_link_remove(self, src_switch, dst_switch):
+        """
+        Function for updating the next-hop table after a link has been removed:
+        only the trees that used the link are recomputed
+        Parameters:
+            src_switch: dpid of one endpoint of the link
+            dst_switch: dpid of the other endpoint of the link
+        Returns:
+            the set of (src, dst) switch pairs whose shortest path changed
+        """
+        u = self.dpid_index[src_switch]
+        v = self.dpid_index[dst_switch]
+        affected = (self.next_hop[u] == v) | (self.next_hop[v] == u)
+        return self._recompute_spf_columns(np.flatnonzero(affected))
+
+    def get_table_path(self, src_switch, dst_switch):
+        """
+        Function for reading the shortest path between two switches from the next-hop table,
+        rebuilding the table first if the topology changed
+        Parameters:
+            src_switch: the source switch of our path
+            dst_switch: the destination switch of our path
+        Returns:
+            a list containing the shortest path between src and dst, None if there is none
+        """
+        if self.next_hop_generation != self.topo_generation:
+            self.build_next_hop_table()
+        src = self.dpid_index.get(str(src_switch))
+        dst = self.dpid_index.get(str(dst_switch))
+        if src is None or dst is None or self.next_hop[src, dst] == -1:
+            return None
+
+        path = [self.index_dpid[src]]
+        while src != dst:
+            src = int(self.next_hop[src, dst])
+            path.append(self.index_dpid[src])
+        return path
+
+    def get_destination_tree(self, dst_mac):
+        """
+        Function for getting the shortest path tree rooted at the switch of a host:
+        for every switch that can reach the host, the port towards it
+        Parameters:
+            dst_mac: the mac address of the destination host
+        Returns:
+            a dictionary switch dpid -> output port, empty if the host is unknown
+        """
+        host = self.host_mac_lookup.get(dst_mac)
+        if host is None:
+            return {}
+        dst_switch = str(host.get_port().dpid)
+        tree = {dst_switch: host.get_port().port_no}
+
+        if self.next_hop_mode and self.cost_function == "hops":
+            if self.next_hop_generation != self.topo_generation:
+                self.build_next_hop_table()
+            dst = self.dpid_index.get(dst_switch)
+            if dst is None:
+                return tree
+            for src in np.flatnonzero(self.next_hop[:, dst] != -1):
+                if src != dst:
+                    tree[self.index_dpid[src]] = self.get_link_port(self.index_dpid[src],
+                                                                    self.index_dpid[self.next_hop[src, dst]])
+            return tree
+
+        weight = "weight" if self.cost_function != "hops" else None
+        try:
+            paths = nx.shortest_path(self.network_graph, target=dst_switch, weight=weight)
+        except nx.NodeNotFound:
+            return tree
+        for src_switch, path in paths.items():
+            if src_switch in self.topo and len(path) > 1:
+                tree[src_switch] = self.get_link_port(src_switch, path[1])
+        return tree
+
+    def get_destination_next_hops(self, dst_mac):
+        """
+        Function for getting, for every switch that can reach a host, the ports on all its equal-cost
+        shortest paths towards the host and a loop-free backup port, used by groups
+        Parameters:
+            dst_mac: the mac address of the destination host
+        Returns:
+            a dictionary switch dpid -> (sorted list of equal-cost ports, backup port or None)
+        """
+        host = self.host_mac_lookup.get(dst_mac)
+        if host is None:
+            return {}
+        dst_switch = str(host.get_port().dpid)
+        weighted = self.cost_function != "hops"
+        switches = self.network_graph.subgraph(self.topo.keys())
+        try:
+            if weighted:
+                dist = nx.single_source_dijkstra_path_length(switches, dst_switch, weight="weight")
+            else:
+                dist = nx.single_source_shortest_path_length(switches, dst_switch)
+        except nx.NodeNotFound:
+            return {}
+
+        next_hops = {}
+        for switch, switch_dist in dist.items():
+            if switch == dst_switch:
+                continue
+            ports = []
+            backups = []
+            for nbr, port in self.topo[switch].items():
+                if nbr not in dist:
+                    continue
+                cost = switches.edges[switch, nbr].get("weight", 1) if weighted else 1
+                if abs(dist[nbr] + cost - switch_dist) < 1e-9:
+                    ports.append(port)
+                elif dist[nbr] < cost + switch_dist:
+                    # Loop-free alternate: the neighbor does not route back through this switch
+                    backups.append((dist[nbr] + cost, port))
+            backup = min(backups)[1] if backups else None
+            next_hops[switch] = (sorted(ports), backup)
+        return next_hops
+
+    def add_dst_rule(self, switch, dst_mac, out_port):
+        """
+        Record in the destination rule dictionary the flow forwarding dst_mac to out_port on a switch.
+        out_port may also describe the group the flow points to.
+        """
+        self.dst_rules.setdefault(switch, {})[dst_mac] = out_port
+
+    def remove_dst_rule(self, switch, dst_mac):
+        """
+        Remove from the destination rule dictionary the flow for dst_mac on a switch.
+        Returns the out port of the removed rule, None if the rule is not found.
+        """
+        rules = self.dst_rules.get(switch)
+        if rules is None:
+            return None
+        out_port = rules.pop(dst_mac, None)
+        if not rules:
+            del self.dst_rules[switch]
+        return out_port
+
+    def get_rule_counts(self):
+        """
+        Function for reporting how many rules of each forwarding mode are installed on every switch
+        Parameters:
+            None
+        Returns:
+            a dictionary switch dpid -> {"pairwise": count, "destination": count, "total": count}
+        """
+        counts = {}
+        for switch in set(self.flow_rules) | set(self.dst_rules):
+            pairwise = len(self.flow_rules.get(switch, {}))
+            destination = len(self.dst_rules.get(switch, {}))
+            counts[switch] = {"pairwise": pairwise, "destination": destination, "total": pairwise + destination}
+        return counts
+
+    def get_link_port(self, src_switch, dst_switch):
+        """
+        Function to retrieve the output port on src_switch of the link towards the adjacent dst_switch
         Parameters:
             src_switch: the source switch 
-            dst_switch: the destination switch
+            dst_switch: the destination switch, adjacent to src_switch
         Returns:
-            the output port if it's found, None otherwise
+            the output port if the two switches are linked, None otherwise
         """
-        src_switch = str(src_switch)
-        dst_switch = str(dst_switch)
+        return self.topo.get(str(src_switch), {}).get(str(dst_switch))
 
+    def get_next_hop_port(self, src_switch, dst_switch):
+        """
+        Function to retrieve the output port on src_switch towards the first hop of the shortest path to dst_switch
+        Parameters:
+            src_switch: the source switch 
+            dst_switch: the destination switch, not necessarily adjacent
+        Returns:
+            the output port if it's found, None otherwise
+        """
         path = self.get_shortest_path(src_switch, dst_switch)
         if path is not None and len(path) > 1:
-            src = path[0]
-            dst = path[1]
-            print(f"Entering get_output_port on src:{src}, dst:{dst}")
-
-            if src in self.topo and dst in self.topo[src]:
-                print(self.topo)
-                return self.topo[src][dst]  # Use the topology dictionary to get the output port
+            return self.get_link_port(path[0], path[1])
 
         return None
     
-    def add_rule_to_dict(self,switch, in_port, out_port):
-        print(f"adding to the rul dict rule for switch {switch} [{in_port}]= {out_port}")
+    def register_path(self, pair, path, backup=None):
+        """
+        Record in the registry the switch path installed for a host pair, replacing the previous one.
+        Every switch port the flows of the pair cross, in both directions, is indexed
+        Parameters:
+            pair: (src_ip, dst_ip) of the host pair
+            path: the list of switches from the switch of src_ip to the switch of dst_ip
+            backup: the link-disjoint backup path, if any
+        Returns:
+            None
+        """
+        self.unregister_path(pair)
+        ports = [(hop, self.topo[hop][nxt]) for hop, nxt in zip(path, path[1:])] + \
+                [(hop, self.topo[hop][prv]) for prv, hop in zip(path, path[1:])]
+        for ip, switch in zip(pair, (path[0], path[-1])):
+            port_no = self.get_host_port_on_switch(self.host_ip_lookup.get(ip), switch)
+            if port_no is not None:
+                ports.append((switch, port_no))
+
+        self.installed_paths[pair] = path
+        self.backup_paths[pair] = backup
+        self.path_ports[pair] = ports
+        for port in ports:
+            self.port_flows.setdefault(port, set()).add(pair)
+        for switch in path:
+            self.switch_flows.setdefault(switch, set()).add(pair)
+        self.endpoint_flows.setdefault((path[0], path[-1]), set()).add(pair)
+
+    def unregister_path(self, pair):
+        """
+        Remove a host pair from the registry of the installed paths
+        Parameters:
+            pair: (src_ip, dst_ip) of the host pair
+        Returns:
+            the switch path that was installed for the pair, None if there was none
+        """
+        path = self.installed_paths.pop(pair, None)
+        if path is None:
+            return None
+        self.backup_paths.pop(pair, None)
+        for index, keys in ((self.port_flows, self.path_ports.pop(pair, [])),
+                            (self.switch_flows, path),
+                            (self.endpoint_flows, [(path[0], path[-1])])):
+            for key in keys:
+                flows = index.get(key)
+                if flows is not None:
+                    flows.discard(pair)
+                    if not flows:
+                        del index[key]
+        return path
+
+    def get_flows_on_port(self, dpid, port_no):
+        """
+        Function for getting the host pairs whose installed path crosses a switch port
+        """
+        return set(self.port_flows.get((str(dpid), port_no), ()))
+
+    def get_flows_on_switch(self, dpid):
+        """
+        Function for getting the host pairs whose installed path crosses a switch
+        """
+        return set(self.switch_flows.get(str(dpid), ()))
+
+    def get_flows_between(self, src_switch, dst_switch):
+        """
+        Function for getting the host pairs whose installed path goes from src_switch to dst_switch
+        """
+        return set(self.endpoint_flows.get((str(src_switch), str(dst_switch)), ()))
+
+    def get_registry(self):
+        """
+        Function for getting the installed path registry in a JSON serializable form
+        """
+        return [{"src": src_ip, "dst": dst_ip, "path": path,
+                 "backup": self.backup_paths.get((src_ip, dst_ip)),
+                 "ports": self.path_ports.get((src_ip, dst_ip), [])}
+                for (src_ip, dst_ip), path in self.installed_paths.items()]
+
+    def add_rule_to_dict(self,switch, in_port, out_port, src_mac, dst_mac):
+        """
+        Record in the rule dictionary the flow installed on a switch for in_port, dl_src and dl_dst.
+        """
+        print(f"adding to the rul dict rule for switch {switch} [{in_port}, {src_mac}->{dst_mac}]= {out_port}")
         if switch not in self.flow_rules:
             self.flow_rules[switch]={}
-        self.flow_rules[switch][in_port]=out_port
+        self.flow_rules[switch][(in_port, src_mac, dst_mac)]=out_port
 
-    def get_rule_from_dict(self, switch, in_port):
+    def get_rule_from_dict(self, switch, in_port, src_mac, dst_mac):
         """
-        Retrieve the out port associated with the given switch and in port from the rule dictionary.
+        Retrieve the out port associated with the given switch, in port, source and destination mac from the rule dictionary.
         Returns None if the rule is not found.
         """
         print(f"searching for {switch} and related rules on the in_port {in_port}")
-        if switch in self.flow_rules and in_port in self.flow_rules[switch]:
-            print(f"found existing rule on {switch}[{in_port}]:{self.flow_rules[switch][in_port]}")
-            return self.flow_rules[switch][in_port]
+        key=(in_port, src_mac, dst_mac)
+        if switch in self.flow_rules and key in self.flow_rules[switch]:
+            print(f"found existing rule on {switch}[{key}]:{self.flow_rules[switch][key]}")
+            return self.flow_rules[switch][key]
         else:
-            print(f"not finding any rules on {switch}[{in_port}]")
+            print(f"not finding any rules on {switch}[{key}]")
+            return None
+
+    def remove_rule_from_dict(self, switch, in_port, src_mac, dst_mac):
+        """
+        Remove from the rule dictionary the flow of the given switch, in port, source and destination mac.
+        Returns the out port of the removed rule, None if the rule is not found.
+        """
+        rules=self.flow_rules.get(switch)
+        if rules is None:
             return None
+        out_port=rules.pop((in_port, src_mac, dst_mac), None)
+        if not rules:
+            del self.flow_rules[switch]
+        return out_port
+
+    def get_pair_rules(self, switch, src_mac, dst_mac):
+        """
+        Retrieve the (in_port, dl_src, dl_dst) keys of the rules installed on a switch for a host pair, in both directions.
+        """
+        pair={(src_mac, dst_mac), (dst_mac, src_mac)}
+        return [key for key in self.flow_rules.get(switch, {}) if key[1:] in pair]
 
 
@@ -0,0 +1,257 @@
+''' Binary wire format of the topology frames sent by the Ryu App to the GUI '''
+
+# Every frame starts with a fixed header followed by arrays of fixed width fields, so that the GUI decodes it
+# straight from its receive buffer with struct, without networkx nor pickle:
+#   header:   version (u8), type (u8), sequence number (u32), record counts (u32, u32)
+#   snapshot: the node kinds (u8 each), the node values (u64 each), then the edges as pairs of node indexes (u32 each)
+#   delta:    operation records (op u8, two nodes as kind u8 and value u64, the second one is zero for node operations)
+#   names:    count (u32) then length (u16) prefixed UTF-8 strings, closing both frame types
+# A node is a switch (its dpid), a host (its IPv4 address), or any other name (its index in the names)
+
+import socket
+import struct
+
+WIRE_VERSION = 2
+
+SNAPSHOT = 0
+DELTA = 1
+
+SWITCH_NODE = 0
+HOST_NODE = 1
+NAME_NODE = 2
+
+HEADER = struct.Struct('!BBIII')
+NODE_SIZE = struct.calcsize('!BQ')     # kind and value of a node in a snapshot
+EDGE_SIZE = struct.calcsize('!II')     # node indexes of an edge in a snapshot
+OP_RECORD = struct.Struct('!BBQBQ')
+NAMES_HEADER = struct.Struct('!I')
+NAME_LENGTH = struct.Struct('!H')
+
+# Byte sent back by the GUI on its connection to ask for a new snapshot
+RESYNC_REQUEST = b'R'
+
+OP_CODES = {"add_node": 0, "remove_node": 1, "add_edge": 2, "remove_edge": 3}
+OP_NAMES = {code: name for name, code in OP_CODES.items()}
+
+
+def encode_node(node, names):
+    """
+    Function for encoding a node name of the GUI graph
+    Parameters:
+        node: the dpid of a switch, the IPv4 address of a host, or any other name, as a string
+        names: dictionary name -> index of the names of the frame, the name is added to it if needed
+    Returns:
+        the (kind, value) pair of the node record
+    """
+    node = str(node)
+    if node.isdigit() and str(int(node)) == node and int(node) < 1 << 64:
+        return SWITCH_NODE, int(node)
+    try:
+        address = socket.inet_pton(socket.AF_INET, node)
+    except OSError:
+        address = None
+    if address is not None and socket.inet_ntoa(address) == node:
+        return HOST_NODE, int.from_bytes(address, 'big')
+    # IPv6 addresses, hosts without an address and anything else travel as strings
+    return NAME_NODE, names.setdefault(node, len(names))
+
+
+def decode_node(kind, value, names):
+    """
+    Function for decoding a node record back to the node name
+    Parameters:
+        kind: SWITCH_NODE, HOST_NODE or NAME_NODE
+        value: the dpid, the address as an integer, or the index of the name
+        names: the list of names of the frame
+    Returns:
+        the node name
+    """
+    if kind == HOST_NODE:
+        return socket.inet_ntoa(value.to_bytes(4, 'big'))
+    if kind == NAME_NODE:
+        if value >= len(names):
+            raise ValueError(f"unknown name index {value}")
+        return names[value]
+    return str(value)
+
+
+def encode_names(names):
+    """
+    Function for encoding the names table closing a frame
+    Parameters:
+        names: dictionary name -> index filled by encode_node
+    Returns:
+        the table as bytes
+    """
+    parts = [NAMES_HEADER.pack(len(names))]
+    for name in sorted(names, key=names.get):
+        data = name.encode('utf-8')[:0xffff]
+        parts.append(NAME_LENGTH.pack(len(data)))
+        parts.append(data)
+    return b''.join(parts)
+
+
+def decode_names(view, offset):
+    """
+    Function for decoding the names table closing a frame
+    Parameters:
+        view: memoryview of the frame
+        offset: where the table starts
+    Returns:
+        the list of names
+    """
+    if len(view) < offset + NAMES_HEADER.size:
+        raise ValueError("truncated names table")
+    count = NAMES_HEADER.unpack_from(view, offset)[0]
+    offset += NAMES_HEADER.size
+    names = []
+    for _ in range(count):
+        if len(view) < offset + NAME_LENGTH.size:
+            raise ValueError("truncated names table")
+        length = NAME_LENGTH.unpack_from(view, offset)[0]
+        offset += NAME_LENGTH.size
+        if len(view) < offset + length:
+            raise ValueError("truncated names table")
+        names.append(str(view[offset:offset + length], 'utf-8'))
+        offset += length
+    if offset != len(view):
+        raise ValueError("trailing bytes after the names table")
+    return names
+
+
+def encode_snapshot(seq, nodes, edges):
+    """
+    Function for encoding the whole topology
+    Parameters:
+        seq: the sequence number of the last change described by the snapshot
+        nodes: the node names
+        edges: the (node, node) pairs
+    Returns:
+        the frame as bytes
+    """
+    nodes = list(nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    names = {}
+    records = [encode_node(node, names) for node in nodes]
+    endpoints = [index[node] for edge in edges for node in edge]
+    count = len(nodes)
+    return b''.join((
+        HEADER.pack(WIRE_VERSION, SNAPSHOT, seq, count, len(endpoints) // 2),
+        struct.pack(f'!{count}B', *[kind for kind, _ in records]),
+        struct.pack(f'!{count}Q', *[value for _, value in records]),
+        struct.pack(f'!{len(endpoints)}I', *endpoints),
+        encode_names(names),
+    ))
+
+
+def encode_delta(seq, ops):
+    """
+    Function for encoding a list of topology changes
+    Parameters:
+        seq: the sequence number of the changes
+        ops: tuples ("add_node" or "remove_node", node) and ("add_edge" or "remove_edge", node, node)
+    Returns:
+        the frame as bytes
+    """
+    frame = bytearray(HEADER.size + OP_RECORD.size * len(ops))
+    HEADER.pack_into(frame, 0, WIRE_VERSION, DELTA, seq, len(ops), 0)
+    offset = HEADER.size
+    names = {}
+    for op in ops:
+        second = encode_node(op[2], names) if len(op) > 2 else (0, 0)
+        OP_RECORD.pack_into(frame, offset, OP_CODES[op[0]], *(encode_node(op[1], names) + second))
+        offset += OP_RECORD.size
+    return bytes(frame) + encode_names(names)
+
+
+def decode(frame):
+    """
+    Function for decoding a frame, the records are read in place from the given buffer
+    Parameters:
+        frame: a bytes-like object holding exactly one frame
+    Returns:
+        {"version", "type": "snapshot", "seq", "nodes", "edges"} or {"version", "type": "delta", "seq", "ops"},
+        with the same shape as the arguments of the encode functions
+    """
+    view = memoryview(frame)
+    if len(view) < HEADER.size:
+        raise ValueError("truncated frame header")
+    version, frame_type, seq, first, second = HEADER.unpack_from(view, 0)
+    if version != WIRE_VERSION:
+        raise ValueError(f"unsupported wire version {version}")
+
+    offset = HEADER.size
+    if frame_type == SNAPSHOT:
+        end = offset + NODE_SIZE * first + EDGE_SIZE * second
+        if len(view) < end:
+            raise ValueError("snapshot size does not match its records")
+        names = decode_names(view, end)
+        kinds = struct.unpack_from(f'!{first}B', view, offset)
+        values = struct.unpack_from(f'!{first}Q', view, offset + first)
+        nodes = [str(value) if kind == SWITCH_NODE else decode_node(kind, value, names)
+                 for kind, value in zip(kinds, values)]
+        endpoints = struct.unpack_from(f'!{2 * second}I', view, offset + NODE_SIZE * first)
+        if endpoints and max(endpoints) >= first:
+            raise ValueError("edge endpoint out of range")
+        endpoints = iter(endpoints)
+        edges = [(nodes[u], nodes[v]) for u, v in zip(endpoints, endpoints)]
+        return {"version": version, "type": "snapshot", "seq": seq, "nodes": nodes, "edges": edges}
+
+    if frame_type == DELTA:
+        end = offset + OP_RECORD.size * first
+        if len(view) < end:
+            raise ValueError("delta size does not match its records")
+        names = decode_names(view, end)
+        ops = []
+        for code, kind_u, u, kind_v, v in OP_RECORD.iter_unpack(view[offset:end]):
+            name = OP_NAMES.get(code)
+            if name is None:
+                raise ValueError(f"unknown operation {code}")
+            if name.endswith("_edge"):
+                ops.append((name, decode_node(kind_u, u, names), decode_node(kind_v, v, names)))
+            else:
+                ops.append((name, decode_node(kind_u, u, names)))
+        return {"version": version, "type": "delta", "seq": seq, "ops": ops}
+
+    raise ValueError(f"unknown frame type {frame_type}")
+
+
+def benchmark(sizes=(10, 100, 1000), repeat=20):
+    """
+    Function for comparing the binary snapshots with the pickled networkx graphs sent before them.
+    Every topology is a ring of switches with extra random links and one host per switch
+    Parameters:
+        sizes: the numbers of switches of the topologies
+        repeat: how many times every encoding and decoding is timed
+    Returns:
+        None, the results are printed
+    """
+    import pickle
+    import random
+    import timeit
+    import networkx as nx
+
+    print(f"{'switches':>8} {'format':>7} {'bytes':>9} {'encode ms':>10} {'decode ms':>10}")
+    for size in sizes:
+        rng = random.Random(size)
+        graph = nx.Graph()
+        for dpid in range(1, size + 1):
+            graph.add_edge(str(dpid), str(dpid % size + 1))
+            graph.add_edge(str(dpid), f"10.0.{dpid // 256}.{dpid % 256}")
+        for _ in range(size):
+            graph.add_edge(str(rng.randint(1, size)), str(rng.randint(1, size)))
+        nodes = list(graph.nodes())
+        edges = list(graph.edges())
+
+        pickled = pickle.dumps(graph)
+        binary = encode_snapshot(0, nodes, edges)
+        for name, data, encode, decode_frame in (
+                ("pickle", pickled, lambda: pickle.dumps(graph), lambda: pickle.loads(pickled)),
+                ("binary", binary, lambda: encode_snapshot(0, nodes, edges), lambda: decode(binary))):
+            encode_ms = min(timeit.repeat(encode, number=1, repeat=repeat)) * 1000
+            decode_ms = min(timeit.repeat(decode_frame, number=1, repeat=repeat)) * 1000
+            print(f"{size:>8} {name:>7} {len(data):>9} {encode_ms:>10.3f} {decode_ms:>10.3f}")
+
+
+if __name__ == '__main__':
+    benchmark()